@@ -0,0 +1,854 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import re
+import time
+from collections import Counter, deque
+from datetime import datetime
+
+from telegram import Bot, Chat, Message, MessageEntity, Update, User
+from telegram.error import RetryAfter
+from telegram.ext import SimpleUpdateProcessor
+from telegram.request import BaseRequest
+
+import bot
+
+# Старая реализация is_spam_message — точка отсчёта для сравнения
+def legacy_is_spam(text: str) -> bool:
+    if not text:
+        return False
+    text = text.lower()
+    spam_patterns = [f'({trigger}){tail}' for _, trigger, tail in bot.SPAM_RULES]
+    spam_score = sum(1 for pattern in spam_patterns if re.search(pattern, text, re.IGNORECASE))
+    emoji_count = len(re.findall(r'[^\w\s]', text))
+    link_count = len(re.findall(r'(http|t\.me|@)', text))
+    if emoji_count > 10 or link_count > 2:
+        spam_score += 1
+    return spam_score >= 2
+
+CHAT_WORDS = (
+    "привет как дела сегодня вечером встречаемся у метро обсудим проект и планы на неделю "
+    "кто идёт завтра на игру скинь фото спасибо между окном learn between window код ревью "
+    "hello there how are you see you tomorrow thanks"
+).split()
+
+SPAM_TEXTS = (
+    "Подписывайтесь на наш канал t.me/spam_channel и заработай 1000$ уже сегодня!!!",
+    "🔥🔥🔥 Казино без вложений, промокод BONUS100 даёт +100% к депозиту 🔥🔥🔥",
+    "Только сегодня! Бесплатный подарок каждому, жми на ссылку @free_gifts_bot",
+    "Join our channel @crypto_signals_pro — invest now, profit 300% guaranteed",
+    "Don't miss: limited offer, trading signals t.me/signals_vip",
+)
+
+def make_corpus(size: int, spam_ratio: float, seed: int = 0):
+    rnd = random.Random(seed)
+    corpus = []
+    for _ in range(size):
+        if rnd.random() < spam_ratio:
+            corpus.append(rnd.choice(SPAM_TEXTS) + " " + str(rnd.randint(1, 999)))
+        else:
+            words = [rnd.choice(CHAT_WORDS) for _ in range(rnd.randint(3, 40))]
+            corpus.append(" ".join(words) + rnd.choice((".", "!", "?", ")", "")))
+    return corpus
+
+def measure(fn, corpus, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn(corpus)
+        best = min(best, time.perf_counter() - started)
+    return len(corpus) / best
+
+def bench_classifier(args):
+    corpus = make_corpus(args.size, args.spam_ratio)
+    classifier = bot.SpamClassifier()
+    legacy = [legacy_is_spam(text) for text in corpus]
+    current = [verdict.is_spam for verdict in classifier.classify_many(corpus)]
+    if legacy != current:
+        raise SystemExit("Расхождение вердиктов со старой реализацией")
+    results = (
+        ("legacy is_spam_message", measure(lambda texts: [legacy_is_spam(t) for t in texts], corpus, args.repeat)),
+        ("SpamClassifier.is_spam", measure(lambda texts: [classifier.is_spam(t) for t in texts], corpus, args.repeat)),
+        ("SpamClassifier.classify_many", measure(classifier.classify_many, corpus, args.repeat)),
+    )
+    print(f"Корпус: {len(corpus)} сообщений, спам: {sum(current)}")
+    for name, rate in results:
+        print(f"{name:<32} {rate:>12,.0f} msg/s")
+
+def make_message_update(update_id: int, chat_id: int, text: str, user_id: int = 1000, username: str = "spam_bot",
+                        is_bot: bool = True) -> Update:
+    chat = Chat(chat_id, Chat.SUPERGROUP)
+    user = User(user_id, username, is_bot, username=username)
+    return Update(update_id, message=Message(update_id, datetime.now(), chat, from_user=user, text=text))
+
+async def run_processor(processor, updates, latency: float):
+    seen = {}
+
+    async def handler(update):
+        await asyncio.sleep(latency)
+        seen.setdefault(update.effective_chat.id, []).append(update.update_id)
+
+    async with processor:
+        started = time.perf_counter()
+        if processor.max_concurrent_updates > 1:
+            await asyncio.gather(*(processor.process_update(u, handler(u)) for u in updates))
+        else:
+            for u in updates:
+                await processor.process_update(u, handler(u))
+        elapsed = time.perf_counter() - started
+    ordered = all(ids == sorted(ids) for ids in seen.values())
+    return len(updates) / elapsed, ordered
+
+async def run_hot_chat(processor, hot: int, quiet: int, latency: float):
+    # Сначала hot апдейтов в один чат, затем по одному в quiet других чатов:
+    # тихие чаты не должны ждать, пока разберётся очередь горячего
+    done = {}
+    started = time.perf_counter()
+
+    async def handler(update):
+        await asyncio.sleep(latency)
+        done[update.update_id] = time.perf_counter() - started
+
+    updates = [make_message_update(i, -1, "x") for i in range(hot)]
+    updates += [make_message_update(hot + i, -2 - i, "x") for i in range(quiet)]
+    async with processor:
+        started = time.perf_counter()
+        await asyncio.gather(*(processor.process_update(u, handler(u)) for u in updates))
+    return max(done[hot + i] for i in range(quiet)), done[hot - 1]
+
+def bench_concurrency(args):
+    print(f"Обработчик: {args.latency * 1000:.0f} мс, апдейтов на чат: {args.per_chat}, воркеров: {args.workers}")
+    for chats in args.chats:
+        updates = [make_message_update(i, -100 - i % chats, "x") for i in range(chats * args.per_chat)]
+        sequential, _ = asyncio.run(run_processor(SimpleUpdateProcessor(1), updates, args.latency))
+        concurrent, ordered = asyncio.run(
+            run_processor(bot.ChatOrderedUpdateProcessor(args.workers), updates, args.latency))
+        print(f"чатов {chats:>3}: последовательно {sequential:>8.1f} upd/s, "
+              f"по чатам {concurrent:>8.1f} upd/s, порядок {'сохранён' if ordered else 'НАРУШЕН'}")
+    hot = args.workers * 2
+    quiet_done, hot_done = asyncio.run(
+        run_hot_chat(bot.ChatOrderedUpdateProcessor(args.workers), hot, args.workers, args.latency))
+    print(f"горячий чат ({hot} апдейтов) + {args.workers} тихих: тихие готовы за {quiet_done * 1000:.0f} мс, "
+          f"горячий — за {hot_done * 1000:.0f} мс")
+
+def legacy_is_tracked(info, target_id: int) -> bool:
+    if target_id in info["ignored_bots"]:
+        return False
+    return target_id in info["bots"].union(info["manual_bots"])
+
+def bench_chatstate(args):
+    rnd = random.Random(0)
+    senders = [rnd.randint(10**9, 2 * 10**9) for _ in range(args.messages)]
+    print(f"Сообщений от неотслеживаемых отправителей: {args.messages}")
+    for size in args.sizes:
+        bots = range(1, size + 1)
+        manual = range(size + 1, size + size // 10 + 2)
+        info = {"bots": set(bots), "manual_bots": set(manual), "ignored_bots": {1}}
+        state = bot.ChatState(bots, manual, [1])
+        legacy = measure(lambda ids: [legacy_is_tracked(info, t) for t in ids], senders, args.repeat)
+        current = measure(lambda ids: [t in state.tracked for t in ids], senders, args.repeat)
+        print(f"ботов {size:>6}: dict+union {1e9 / legacy:>10.0f} нс/сообщ., ChatState.tracked {1e9 / current:>6.0f} нс/сообщ.")
+
+FAKE_BOT_ID = 777
+FAKE_TOKEN = f"{FAKE_BOT_ID}:fake-token"
+
+class FakeTelegramRequest(BaseRequest):
+    # Локальный «сервер» Bot API: отвечает на вызовы бота без сети, с настраиваемой
+    # задержкой, случайными ошибками и серверным флуд-контролем (429 + retry_after)
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, chat_limit: int = 0,
+                 global_limit: int = 0, retry_after: int = 1, seed: int = 0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.chat_limit = chat_limit
+        self.global_limit = global_limit
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.calls = Counter()
+        self.flood_errors = 0
+        self.deleted = set()
+        self.deleted_at = {}
+        self.inbox = []
+        self._arrived = None
+        self._windows = {}
+        self._message_id = 1000
+        self.admins = {}
+        self.admin_bots = {}
+        self.kicked = set()
+        self.no_rights = set()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _flooded(self, key, limit: int, now: float) -> bool:
+        window = self._windows.setdefault(key, deque())
+        while window and window[0] <= now - 1:
+            window.popleft()
+        if len(window) >= limit:
+            return True
+        window.append(now)
+        return False
+
+    def _message(self, chat_id: int, text: str = ""):
+        self._message_id += 1
+        return {"message_id": self._message_id, "date": int(time.time()), "text": text,
+                "chat": {"id": chat_id, "type": "supergroup", "title": f"chat {chat_id}"},
+                "from": {"id": FAKE_BOT_ID, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}}
+
+    def _result(self, endpoint: str, params):
+        chat_id = int(params["chat_id"]) if "chat_id" in params else None
+        if endpoint == "getMe":
+            return {"id": FAKE_BOT_ID, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+        if endpoint == "deleteMessage":
+            key = (chat_id, int(params["message_id"]))
+            self.deleted.add(key)
+            self.deleted_at[key] = time.perf_counter()
+            return True
+        if endpoint == "deleteMessages":
+            self.deleted.update((chat_id, message_id) for message_id in json.loads(params["message_ids"]))
+            return True
+        if endpoint in ("sendMessage", "editMessageText"):
+            return self._message(chat_id, params.get("text", ""))
+        if endpoint == "getChatMember":
+            user_id = int(params["user_id"])
+            if user_id == FAKE_BOT_ID and chat_id in self.no_rights:
+                return {"status": "member", "user": self._result("getMe", {})}
+            if user_id == FAKE_BOT_ID:
+                return {"status": "administrator", "user": self._result("getMe", {}), "can_be_edited": False,
+                        "is_anonymous": False, "can_manage_chat": True, "can_delete_messages": True,
+                        "can_manage_video_chats": False, "can_restrict_members": True,
+                        "can_promote_members": False, "can_change_info": False, "can_invite_users": True}
+            return {"status": "member", "user": {"id": user_id, "is_bot": False, "first_name": "User"}}
+        if endpoint == "getChatAdministrators":
+            admins = [{"status": "creator", "is_anonymous": False,
+                       "user": {"id": user_id, "is_bot": False, "first_name": "Admin"}}
+                      for user_id in self.admins.get(chat_id, ())]
+            admins += [{"status": "administrator", "user": {"id": bot_id, "is_bot": True, "first_name": "Bot",
+                                                             "username": f"bot{bot_id}_bot"},
+                        "can_be_edited": False, "is_anonymous": False, "can_manage_chat": True,
+                        "can_delete_messages": False, "can_manage_video_chats": False, "can_restrict_members": False,
+                        "can_promote_members": False, "can_change_info": False, "can_invite_users": False}
+                       for bot_id in self.admin_bots.get(chat_id, ())]
+            admins.append(self._result("getChatMember", {"chat_id": chat_id, "user_id": FAKE_BOT_ID}))
+            return admins
+        if endpoint == "getChat":
+            return {"id": chat_id, "type": "private", "first_name": f"Bot {chat_id}", "username": f"bot{chat_id}_bot"}
+        return True
+
+    def push_update(self, data):
+        self.inbox.append(data)
+        if self._arrived is not None:
+            self._arrived.set()
+
+    async def _get_updates(self, params):
+        # Long polling как у Telegram: ответ сразу, как только появился апдейт, иначе по таймауту
+        offset = int(params.get("offset") or 0)
+        self.inbox = [data for data in self.inbox if data["update_id"] >= offset]
+        if not self.inbox and float(params.get("timeout") or 0):
+            self._arrived = asyncio.Event()
+            try:
+                await asyncio.wait_for(self._arrived.wait(), float(params["timeout"]))
+            except asyncio.TimeoutError:
+                pass
+        return self.inbox[:100]
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.json_parameters if request_data else {}
+        self.calls[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if endpoint == "getUpdates":
+            return 200, json.dumps({"ok": True, "result": await self._get_updates(params)}).encode()
+        now = time.monotonic()
+        flooded = (self.global_limit and self._flooded(None, self.global_limit, now)) or (
+            self.chat_limit and "chat_id" in params and self._flooded(params["chat_id"], self.chat_limit, now))
+        if flooded:
+            self.flood_errors += 1
+            body = {"ok": False, "error_code": 429, "description": f"Too Many Requests: retry after {self.retry_after}",
+                    "parameters": {"retry_after": self.retry_after}}
+            return 429, json.dumps(body).encode()
+        if "chat_id" in params and int(params["chat_id"]) in self.kicked:
+            body = {"ok": False, "error_code": 403, "description": "Forbidden: bot was kicked from the supergroup chat"}
+            return 403, json.dumps(body).encode()
+        if self.error_rate and endpoint != "getMe" and self.random.random() < self.error_rate:
+            body = {"ok": False, "error_code": 400, "description": "Bad Request: injected error"}
+            return 400, json.dumps(body).encode()
+        return 200, json.dumps({"ok": True, "result": self._result(endpoint, params)}).encode()
+
+async def make_fake_bot(request: FakeTelegramRequest) -> Bot:
+    fake_bot = Bot(FAKE_TOKEN, request=request, get_updates_request=request)
+    await fake_bot.initialize()
+    return fake_bot
+
+async def run_spam_wave(use_scheduler: bool, args):
+    request = FakeTelegramRequest(chat_limit=args.chat_limit, global_limit=args.global_limit,
+                                  retry_after=args.retry_after, latency=args.latency)
+    fake_bot = await make_fake_bot(request)
+    scheduler = bot.ApiScheduler(args.global_rate, args.chat_rate, args.chat_burst)
+    finished = {"delete": [], "notice": []}
+    lost = Counter()
+    started = time.perf_counter()
+
+    async def send(kind: str, priority: int, chat_id: int, factory):
+        try:
+            if use_scheduler:
+                retries = bot.API_MAX_RETRIES if priority == bot.PRIORITY_DELETE else 0
+                await scheduler.call(priority, chat_id, factory, retries=retries)
+            else:
+                await factory()
+            finished[kind].append(time.perf_counter() - started)
+        except RetryAfter:
+            lost[kind] += 1
+
+    if use_scheduler:
+        scheduler.start()
+    jobs = []
+    for n in range(args.per_chat):
+        for c in range(args.chats):
+            chat_id = -1000 - c
+            jobs.append(send("delete", bot.PRIORITY_DELETE, chat_id,
+                             lambda chat_id=chat_id, n=n: fake_bot.delete_message(chat_id, n + 1)))
+            jobs.append(send("notice", bot.PRIORITY_NOTICE, chat_id,
+                             lambda chat_id=chat_id: fake_bot.send_message(chat_id, "🚫 Удалена реклама")))
+    await asyncio.gather(*jobs)
+    elapsed = time.perf_counter() - started
+    await scheduler.stop()
+    return elapsed, finished, lost, request, scheduler
+
+def mean(values):
+    return sum(values) / len(values) if values else 0.0
+
+def bench_ratelimit(args):
+    total = args.chats * args.per_chat
+    print(f"Волна спама: {args.chats} чатов × {args.per_chat} удалений (+ столько же уведомлений), "
+          f"сервер: {args.chat_limit}/с на чат, {args.global_limit}/с всего, retry_after={args.retry_after}")
+    for use_scheduler in (False, True):
+        elapsed, finished, lost, request, scheduler = asyncio.run(run_spam_wave(use_scheduler, args))
+        print(f"\n{'ApiScheduler' if use_scheduler else 'Напрямую'}: {elapsed:.2f} с, 429 от сервера: {request.flood_errors}")
+        print(f"  удалено {len(finished['delete'])}/{total}, потеряно {lost['delete']}, "
+              f"среднее время удаления {mean(finished['delete']):.2f} с")
+        print(f"  уведомлений {len(finished['notice'])}/{total}, потеряно {lost['notice']}, "
+              f"среднее время {mean(finished['notice']):.2f} с")
+        if use_scheduler:
+            print(f"  метрики: {scheduler.stats()}")
+
+ADMIN_USER_ID = 4242
+
+def message_dict(update_id: int, chat_id: int, user_id: int, username: str, text: str, is_bot: bool = False):
+    message = {
+        "message_id": update_id, "date": int(time.time()), "text": text,
+        "chat": {"id": chat_id, "type": "supergroup", "title": f"chat {chat_id}"},
+        "from": {"id": user_id, "is_bot": is_bot, "first_name": username, "username": username},
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    elif SERVER_ENTITY_RE.search(text):
+        message["entities"] = [entity.to_dict() for entity in server_entities(text)]
+    return {"update_id": update_id, "message": message}
+
+def scenario_spam_wave(args):
+    rnd = random.Random(1)
+    corpus = make_corpus(args.updates, args.spam_ratio, seed=1)
+    updates = []
+    for i, text in enumerate(corpus, 1):
+        chat_id = -1000 - rnd.randrange(args.chats)
+        if rnd.random() < 0.5:
+            updates.append(message_dict(i, chat_id, 500 + chat_id % 7, "ad_bot", text, is_bot=True))
+        else:
+            updates.append(message_dict(i, chat_id, 10_000 + rnd.randrange(1000), "person", text))
+    return updates
+
+def scenario_botlist(args):
+    chat_id = -1000
+    state = bot.chat_data[chat_id] = bot.ChatState()
+    for bot_id in range(1, args.bots + 1):
+        state.add_manual(10**9 + bot_id)
+    return [message_dict(i, chat_id, ADMIN_USER_ID, "admin", "/botlist") for i in range(1, args.updates + 1)]
+
+def scenario_addbot(args):
+    updates = []
+    for i in range(1, args.updates + 1):
+        chat_id = -1000 - i % args.chats
+        ids = " ".join(str(10**9 + i * args.bots + n) for n in range(args.bots))
+        updates.append(message_dict(i, chat_id, ADMIN_USER_ID, "admin", f"/addbot {ids}"))
+    return updates
+
+REPLAY_SCENARIOS = {"spamwave": scenario_spam_wave, "botlist": scenario_botlist, "addbot": scenario_addbot}
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+async def measure_loop_lag(samples, stop: asyncio.Event, interval: float = 0.005):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - started - interval)
+
+async def run_replay(args, workdir: str):
+    bot.DATA_FILE = os.path.join(workdir, "bot_data.json")
+    bot.deletion_scheduler.path = os.path.join(workdir, "pending_deletions.json")
+    bot.chat_data.attach(bot.JsonStorage(bot.DATA_FILE))
+    bot.CONCURRENT_UPDATES = args.workers
+    bot.api_scheduler.global_bucket = bot.TokenBucket(args.global_rate, args.global_rate)
+    bot.api_scheduler.chat_rate = args.chat_rate
+    request = FakeTelegramRequest(latency=args.latency, error_rate=args.error_rate, seed=2)
+    fake_bot = await make_fake_bot(request)
+    if args.updates_file:
+        with open(args.updates_file, encoding="utf-8") as f:
+            raw_updates = [json.loads(line) for line in f if line.strip()]
+    else:
+        raw_updates = REPLAY_SCENARIOS[args.scenario](args)
+    for raw in raw_updates:
+        chat = (raw.get("message") or {}).get("chat")
+        if chat:
+            request.admins[chat["id"]] = (ADMIN_USER_ID,)
+    updates = [Update.de_json(raw, fake_bot) for raw in raw_updates]
+
+    application = bot.build_application(bot=fake_bot)
+    samples = {}
+
+    def record(callback):
+        async def wrapper(update, context):
+            started = time.perf_counter()
+            try:
+                return await callback(update, context)
+            finally:
+                samples.setdefault(callback.__name__, []).append(time.perf_counter() - started)
+        wrapper.__name__ = callback.__name__
+        return wrapper
+
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = record(handler.callback.__wrapped__)
+
+    lag = []
+    stop = asyncio.Event()
+    async with application:
+        await bot.on_startup(application)
+        lag_task = asyncio.create_task(measure_loop_lag(lag, stop))
+        started = time.perf_counter()
+        await application.start()
+        for update in updates:
+            await application.update_queue.put(update)
+        await application.update_queue.join()
+        await application.stop()
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await lag_task
+        await bot.on_shutdown(application)
+    return len(updates), elapsed, samples, lag, request
+
+async def post_update(port: int, secret: str, data) -> int:
+    body = json.dumps(data).encode()
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(f"POST {WEBHOOK_BENCH_PATH} HTTP/1.1\r\nHost: 127.0.0.1\r\nContent-Type: application/json\r\n"
+                 f"X-Telegram-Bot-Api-Secret-Token: {secret}\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    writer.close()
+    return status
+
+WEBHOOK_BENCH_PATH = "/telegram"
+WEBHOOK_BENCH_SECRET = "bench-secret"
+
+async def run_ingress(args, workdir: str):
+    bot.DATA_FILE = os.path.join(workdir, "bot_data.json")
+    bot.deletion_scheduler.path = os.path.join(workdir, "pending_deletions.json")
+    bot.chat_data.attach(bot.JsonStorage(bot.DATA_FILE))
+    bot.INGRESS_MODE = args.mode
+    request = FakeTelegramRequest(latency=args.latency)
+    fake_bot = await make_fake_bot(request)
+    if args.updates_file:
+        with open(args.updates_file, encoding="utf-8") as f:
+            raw_updates = [json.loads(line) for line in f if line.strip()]
+    else:
+        raw_updates = scenario_spam_wave(args)
+    for raw in raw_updates:
+        chat = (raw.get("message") or {}).get("chat")
+        if chat:
+            request.admins[chat["id"]] = (ADMIN_USER_ID,)
+    application = bot.build_application(bot=fake_bot, updater=args.mode == "polling")
+    sent = {}
+    statuses = Counter()
+    async with application:
+        await bot.on_startup(application)
+        await application.start()
+        if args.mode == "polling":
+            await application.updater.start_polling(poll_interval=0, timeout=10,
+                                                    allowed_updates=bot.allowed_update_types(application))
+        else:
+            intake = bot.WebhookIntake(bot.application_sink(application), WEBHOOK_BENCH_PATH,
+                                       WEBHOOK_BENCH_SECRET, args.queue_size)
+            server = await intake.start("127.0.0.1", 0)
+            port = server.sockets[0].getsockname()[1]
+        started = time.perf_counter()
+        for raw in raw_updates:
+            message = raw.get("message") or {}
+            sent[(message.get("chat", {}).get("id"), message.get("message_id"))] = time.perf_counter()
+            if args.mode == "polling":
+                request.push_update(raw)
+            else:
+                # Как Telegram: на 503 доставка повторяется позже
+                while (status := await post_update(port, WEBHOOK_BENCH_SECRET, raw)) == 503:
+                    statuses[status] += 1
+                    await asyncio.sleep(0.05)
+                statuses[status] += 1
+            if args.rate:
+                await asyncio.sleep(1 / args.rate)
+        # Ждём, пока удаления перестанут появляться
+        seen = -1
+        while seen != len(request.deleted_at):
+            seen = len(request.deleted_at)
+            await asyncio.sleep(0.5)
+        elapsed = time.perf_counter() - started - 0.5
+        if args.mode == "polling":
+            await application.updater.stop()
+        else:
+            server.close()
+            await server.wait_closed()
+            await intake.drain()
+        await application.stop()
+        await bot.on_shutdown(application)
+    latencies = [request.deleted_at[key] - sent[key] for key in request.deleted_at if key in sent]
+    return len(raw_updates), elapsed, latencies, statuses, request
+
+def bench_ingress(args):
+    import tempfile
+    with tempfile.TemporaryDirectory() as workdir:
+        count, elapsed, latencies, statuses, request = asyncio.run(run_ingress(args, workdir))
+    print(f"Режим: {args.mode}, апдейтов: {count}, темп: {args.rate or 'максимальный'} upd/s, "
+          f"задержка API: {args.latency * 1000:.0f} мс")
+    print(f"Пропускная способность: {count / elapsed:,.1f} upd/s ({elapsed:.2f} с)")
+    print(f"Поступление -> удаление: n={len(latencies)} p50={percentile(latencies, 0.5) * 1000:.1f} мс "
+          f"p99={percentile(latencies, 0.99) * 1000:.1f} мс")
+    if statuses:
+        print(f"Ответы webhook: {dict(statuses)}")
+    print(f"Вызовы API: {dict(request.calls)}")
+
+def bench_replay(args):
+    import tempfile
+    with tempfile.TemporaryDirectory() as workdir:
+        count, elapsed, samples, lag, request = asyncio.run(run_replay(args, workdir))
+    print(f"Сценарий: {args.updates_file or args.scenario}, апдейтов: {count}, воркеров: {args.workers}, "
+          f"задержка API: {args.latency * 1000:.0f} мс, ошибки API: {args.error_rate:.0%}")
+    print(f"Пропускная способность: {count / elapsed:,.1f} upd/s ({elapsed:.2f} с)")
+    for name, values in sorted(samples.items()):
+        print(f"  {name:<22} n={len(values):<6} p50={percentile(values, 0.5) * 1000:8.2f} мс "
+              f"p99={percentile(values, 0.99) * 1000:8.2f} мс")
+    print(f"Лаг event loop: p50={percentile(lag, 0.5) * 1000:.2f} мс, p99={percentile(lag, 0.99) * 1000:.2f} мс, "
+          f"max={max(lag, default=0) * 1000:.2f} мс")
+    print(f"Вызовы API: {dict(request.calls)}")
+
+CAMPAIGN_TEMPLATES = (
+    "🔥 Подписывайтесь на наш канал {link} и заработай {n}$ за неделю без вложений, пиши {mention}",
+    "Казино {mention}: промокод BONUS{n} даёт +{n}% к первому депозиту, только сегодня, жми {link}",
+    "Join our channel {link} — invest now and get {n}% profit every week, limited offer from {mention}",
+    "Бесплатный подарок {n} рублей каждому новому участнику, не упусти, ссылка {link} и бот {mention}",
+)
+FILLERS = ("", " 🔥", " !!!", " 👉", " срочно", " ✅✅", " 💰")
+
+NEAR_CLEAN_WORDS = ("погода", "завтра", "встреча", "обед", "отчёт", "дорога", "собака", "книга", "музыка",
+                    "работа", "вечер", "поезд", "кофе", "окно", "сосед", "дача", "ремонт", "билет")
+
+def near_clean_pair(rnd):
+    # Реклама и чистый текст из тех же слов без ссылки и триггеров: скетч у них почти общий
+    words = " ".join(rnd.sample(NEAR_CLEAN_WORDS, 10))
+    return f"join our channel t.me/w{rnd.randint(1, 999)} {words}", f"join {words}"
+
+def make_campaign_corpus(size: int, campaigns: int, spam_ratio: float, seed: int = 3, near_clean_ratio: float = 0.0,
+                         exact_ratio: float = 0.0):
+    # exact_ratio — доля копий, разосланных дословно (без своего числа и хвоста)
+    rnd = random.Random(seed)
+    variants = [(rnd.choice(CAMPAIGN_TEMPLATES), f"t.me/promo_{c}", f"@promo_{c}_bot") for c in range(campaigns)]
+    clean = make_corpus(size, 0.0, seed)
+    corpus = []
+    for i in range(size):
+        if rnd.random() < near_clean_ratio:
+            corpus.extend(near_clean_pair(rnd))
+        elif rnd.random() < spam_ratio:
+            template, link, mention = rnd.choice(variants)
+            if rnd.random() < exact_ratio:
+                corpus.append(template.format(link=link, mention=mention, n=100))
+            else:
+                corpus.append(template.format(link=link, mention=mention, n=rnd.randint(10, 999)) + rnd.choice(FILLERS))
+        else:
+            corpus.append(clean[i])
+    return corpus
+
+def bench_fingerprint(args):
+    plain = bot.SpamClassifier()
+    fresh = lambda texts: bot.SpamClassifier(cache=bot.FingerprintCache(args.cache_size)).classify_many(texts)
+    for exact_ratio in args.exact_ratio:
+        corpus = make_campaign_corpus(args.size, args.campaigns, args.spam_ratio,
+                                      near_clean_ratio=args.near_clean_ratio, exact_ratio=exact_ratio)
+        expected = [verdict.is_spam for verdict in plain.classify_many(corpus)]
+        cached = bot.SpamClassifier(cache=bot.FingerprintCache(args.cache_size))
+        got = [verdict.is_spam for verdict in cached.classify_many(corpus)]
+        disagree = sum(1 for a, b in zip(expected, got) if a != b)
+        stats = cached.cache.stats()
+        print(f"Корпус: {len(corpus)} сообщений, кампаний: {args.campaigns}, спам: {sum(expected)}, "
+              f"дословных копий: {exact_ratio:.0%}")
+        print(f"Кэш: точных {stats['exact_hits']}, похожих {stats['near_hits']} "
+              f"(отклонено правилами {stats['near_rejected']}), промахов {stats['misses']}, "
+              f"hit rate {stats['hit_rate']:.1%}, расхождений с полной проверкой: {disagree}")
+        for name, fn in (("без кэша", plain.classify_many), ("с кэшем отпечатков", fresh)):
+            print(f"  {name:<22} {measure(fn, corpus, args.repeat):>12,.0f} msg/s")
+
+HIDDEN_LINK_TEXTS = (
+    "Подписывайтесь на наш канал, там всё подробно",
+    "Наша группа ждёт тебя, вход здесь",
+    "Казино онлайн, заходи",
+    "Our channel is open for everyone, come in",
+)
+SERVER_ENTITY_RE = re.compile(r'https?://\S+|t\.me/\S+|@[A-Za-z0-9_]{5,}')
+
+def utf16_len(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+def server_entities(text: str):
+    # Упрощённая разметка, которую Telegram присылает вместе с текстом
+    entities = []
+    for match in SERVER_ENTITY_RE.finditer(text):
+        kind = MessageEntity.MENTION if match.group().startswith("@") else MessageEntity.URL
+        entities.append(MessageEntity(kind, utf16_len(text[:match.start()]), utf16_len(match.group())))
+    return tuple(entities)
+
+def make_entity_corpus(size: int, spam_ratio: float, hidden_ratio: float, seed: int = 4):
+    rnd = random.Random(seed)
+    corpus = []
+    for text in make_corpus(size, spam_ratio, seed):
+        entities = server_entities(text)
+        if rnd.random() < hidden_ratio:
+            text = rnd.choice(HIDDEN_LINK_TEXTS)
+            entities = (MessageEntity(MessageEntity.TEXT_LINK, 0, utf16_len(text),
+                                      url=f"https://t.me/+invite{rnd.randint(1, 999)}"),)
+        corpus.append((text, entities))
+    return corpus
+
+def bench_entities(args):
+    corpus = make_entity_corpus(args.size, args.spam_ratio, args.hidden_ratio)
+    classifier = bot.SpamClassifier()
+    by_text = [classifier.classify(text).is_spam for text, _ in corpus]
+    by_entities = [classifier.classify(text, bot.extract_features(text, entities)).is_spam
+                   for text, entities in corpus]
+    only_entities = sum(1 for a, b in zip(by_text, by_entities) if b and not a)
+    only_text = sum(1 for a, b in zip(by_text, by_entities) if a and not b)
+    print(f"Корпус: {len(corpus)} сообщений, спам по тексту: {sum(by_text)}, по сущностям: {sum(by_entities)}")
+    print(f"Только по сущностям (скрытые ссылки): {only_entities}, только по тексту: {only_text}")
+    texts = lambda items: [classifier.classify(text) for text, _ in items]
+    entities = lambda items: [classifier.classify(text, bot.extract_features(text, ents)) for text, ents in items]
+    for name, fn in (("regex по тексту", texts), ("сущности + текст", entities)):
+        print(f"{name:<22} {measure(fn, corpus, args.repeat):>12,.0f} msg/s")
+
+def shard_worker(queue, results):
+    # Та же CPU-работа, что у шарда на каждое сообщение: разбор апдейта, признаки, классификация
+    classifier = bot.SpamClassifier()
+    order = {}
+    while True:
+        data = queue.get()
+        if data is None:
+            break
+        message = Update.de_json(data, None).message
+        text = message.text or ""
+        classifier.classify(text, bot.extract_features(text, message.entities))
+        order.setdefault(message.chat.id, []).append(message.message_id)
+    results.put(order)
+
+def run_shards(raw_updates, shards: int):
+    ctx = multiprocessing.get_context("spawn")
+    queues = [ctx.Queue() for _ in range(shards)]
+    results = ctx.Queue()
+    workers = [ctx.Process(target=shard_worker, args=(queue, results)) for queue in queues]
+    for worker in workers:
+        worker.start()
+    started = time.perf_counter()
+    for raw in raw_updates:
+        queues[bot.chat_shard(bot.raw_update_chat_id(raw), shards)].put(raw)
+    for queue in queues:
+        queue.put(None)
+    orders = [results.get() for _ in workers]
+    elapsed = time.perf_counter() - started
+    for worker in workers:
+        worker.join()
+    ordered = all(ids == sorted(ids) for order in orders for ids in order.values())
+    return elapsed, ordered
+
+def bench_shards(args):
+    raw_updates = scenario_spam_wave(args)
+    print(f"Апдейтов: {len(raw_updates)}, чатов: {args.chats}, ядер: {os.cpu_count()}")
+    for shards in args.shards:
+        elapsed, ordered = run_shards(raw_updates, shards)
+        print(f"шардов {shards:<3} {len(raw_updates) / elapsed:>10,.0f} upd/s  "
+              f"порядок внутри чатов {'сохранён' if ordered else 'НАРУШЕН'}")
+
+def legacy_overview(chats):
+    total_bots = sum(state.bot_count() for state in chats.values())
+    top = sorted(chats.items(), key=lambda x: x[1].bot_count(), reverse=True)[:5]
+    first = list(chats.items())[:10]
+    return len(chats), total_bots, top, first
+
+def bench_overview(args):
+    rnd = random.Random(6)
+    bot.chat_data.clear()
+    for chat_id in range(args.chats):
+        state = bot.chat_data[-1000 - chat_id] = bot.ChatState(rnd.sample(range(10**9, 10**9 + 500), rnd.randrange(20)))
+        state.deleted = rnd.randrange(100)
+    plain = {chat_id: state for chat_id, state in bot.chat_data.items()}
+    rounds = range(args.repeat)
+    legacy = measure(lambda r: [legacy_overview(plain) for _ in r], rounds, 3)
+    async def views(r):
+        return [(await bot.chat_overview(), await bot.chat_page()) for _ in r]
+    async def pages(r, cursor):
+        return [await bot.chat_page(cursor) for _ in r]
+    # asyncio.run на каждый замер дороже самих просмотров — берём раундов побольше
+    many = range(args.repeat * 100)
+    current = measure(lambda r: asyncio.run(views(r)), many, 3)
+    cursor = asyncio.run(bot.chat_page())[1]
+    paged = measure(lambda r: asyncio.run(pages(r, cursor)), many, 3)
+    print(f"Чатов: {args.chats}")
+    print(f"{'сортировка и суммы по всем чатам':<36} {legacy:>12,.1f} просмотров/с")
+    print(f"{'ChatIndex: сводка + первая страница':<36} {current:>12,.1f} просмотров/с")
+    print(f"{'ChatIndex: страница по курсору':<36} {paged:>12,.1f} просмотров/с")
+
+async def run_rescan(args):
+    rnd = random.Random(7)
+    request = FakeTelegramRequest(latency=args.latency)
+    fake_bot = await make_fake_bot(request)
+    bot.chat_data.clear()
+    bot.api_scheduler.global_bucket = bot.TokenBucket(args.global_rate, args.global_rate)
+    for i in range(args.chats):
+        chat_id = -1000 - i
+        known = [10**9 + i * 10 + n for n in range(rnd.randrange(4))]
+        bot.chat_data[chat_id] = bot.ChatState(known)
+        # Часть ботов-админов уже известна, часть появилась без нашего ведома
+        request.admin_bots[chat_id] = known[:1] + [10**9 + i * 10 + 5 + n for n in range(rnd.randrange(3))]
+        roll = rnd.random()
+        if roll < args.kicked:
+            request.kicked.add(chat_id)
+        elif roll < args.kicked + args.no_rights:
+            request.no_rights.add(chat_id)
+    bot.data_saver.dirty.clear()
+    rescanner = bot.RosterRescanner(0, concurrency=args.concurrency, jitter=args.jitter)
+    rescanner.bot = fake_bot
+    bot.api_scheduler.start()
+    try:
+        first = await rescanner.scan()
+        dirty = len(bot.data_saver.dirty)
+        second = await rescanner.scan()
+    finally:
+        await bot.api_scheduler.stop()
+    return first, dirty, second, request
+
+def bench_rescan(args):
+    first, dirty, second, request = asyncio.run(run_rescan(args))
+    for name, run in (("первый проход", first), ("повторный", second)):
+        print(f"{name:<14} чатов {run['chats']}, {run['seconds']:.2f} с, изменено {run['changed']}, "
+              f"без прав {run['lost_rights']}, недоступно {run['removed']}, ошибок {run['errors']}")
+    print(f"Помечено к сохранению после первого прохода: {dirty}")
+    print(f"Вызовы API: {dict(request.calls)}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки бота")
+    sub = parser.add_subparsers(dest="scenario", required=True)
+    p = sub.add_parser("classifier", help="Скорость классификатора спама")
+    p.add_argument("--size", type=int, default=20000)
+    p.add_argument("--spam-ratio", type=float, default=0.05)
+    p.add_argument("--repeat", type=int, default=5)
+    p.set_defaults(func=bench_classifier)
+    p = sub.add_parser("concurrency", help="Пропускная способность ChatOrderedUpdateProcessor")
+    p.add_argument("--chats", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    p.add_argument("--per-chat", type=int, default=20)
+    p.add_argument("--workers", type=int, default=16)
+    p.add_argument("--latency", type=float, default=0.01)
+    p.set_defaults(func=bench_concurrency)
+    p = sub.add_parser("chatstate", help="Проверка отслеживаемого отправителя в handle_message")
+    p.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    p.add_argument("--messages", type=int, default=20000)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_chatstate)
+    p = sub.add_parser("ratelimit", help="Волна удалений против фейкового API с 429")
+    p.add_argument("--chats", type=int, default=10)
+    p.add_argument("--per-chat", type=int, default=10)
+    p.add_argument("--chat-limit", type=int, default=5)
+    p.add_argument("--global-limit", type=int, default=30)
+    p.add_argument("--retry-after", type=int, default=1)
+    p.add_argument("--latency", type=float, default=0.005)
+    p.add_argument("--global-rate", type=float, default=bot.API_GLOBAL_RATE)
+    p.add_argument("--chat-rate", type=float, default=4)
+    p.add_argument("--chat-burst", type=float, default=4)
+    p.set_defaults(func=bench_ratelimit)
+    p = sub.add_parser("replay", help="Прогон апдейтов через обработчики Application с фейковым Bot")
+    p.add_argument("--scenario", choices=sorted(REPLAY_SCENARIOS), default="spamwave")
+    p.add_argument("--updates-file", help="JSONL с записанными апдейтами (Update.to_dict())")
+    p.add_argument("--updates", type=int, default=2000)
+    p.add_argument("--chats", type=int, default=50)
+    p.add_argument("--bots", type=int, default=30)
+    p.add_argument("--spam-ratio", type=float, default=0.3)
+    p.add_argument("--workers", type=int, default=bot.CONCURRENT_UPDATES)
+    p.add_argument("--latency", type=float, default=0.02)
+    p.add_argument("--error-rate", type=float, default=0.0)
+    p.add_argument("--global-rate", type=float, default=1000)
+    p.add_argument("--chat-rate", type=float, default=1000)
+    p.set_defaults(func=bench_replay)
+    p = sub.add_parser("fingerprint", help="Кэш отпечатков на корпусе рекламных кампаний")
+    p.add_argument("--size", type=int, default=20000)
+    p.add_argument("--campaigns", type=int, default=20)
+    # classify() вызывается только для отслеживаемых ботов, среди их сообщений реклама — большинство
+    p.add_argument("--spam-ratio", type=float, default=0.6)
+    p.add_argument("--near-clean-ratio", type=float, default=0.02,
+                   help="доля пар «реклама + чистый текст из тех же слов»")
+    p.add_argument("--exact-ratio", type=float, nargs="+", default=[0.0, 0.9],
+                   help="доли дословных копий кампании, по прогону на каждую")
+    p.add_argument("--cache-size", type=int, default=20000)
+    p.add_argument("--repeat", type=int, default=3)
+    p.set_defaults(func=bench_fingerprint)
+    p = sub.add_parser("entities", help="Признаки из сущностей сообщения против regex по тексту")
+    p.add_argument("--size", type=int, default=20000)
+    p.add_argument("--spam-ratio", type=float, default=0.3)
+    p.add_argument("--hidden-ratio", type=float, default=0.05)
+    p.add_argument("--repeat", type=int, default=5)
+    p.set_defaults(func=bench_entities)
+    p = sub.add_parser("shards", help="Разбор и классификация апдейтов в процессах-шардах")
+    p.add_argument("--updates", type=int, default=20000)
+    p.add_argument("--chats", type=int, default=200)
+    p.add_argument("--spam-ratio", type=float, default=0.3)
+    p.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4])
+    p.set_defaults(func=bench_shards)
+    p = sub.add_parser("ingress", help="Поступление апдейта -> удаление: long polling против webhook")
+    p.add_argument("--mode", choices=("polling", "webhook"), default="webhook")
+    p.add_argument("--updates", type=int, default=2000)
+    p.add_argument("--chats", type=int, default=50)
+    p.add_argument("--spam-ratio", type=float, default=0.3)
+    p.add_argument("--rate", type=float, default=500, help="апдейтов в секунду, 0 — без пауз")
+    p.add_argument("--latency", type=float, default=0.02)
+    p.add_argument("--queue-size", type=int, default=bot.WEBHOOK_QUEUE_SIZE)
+    p.add_argument("--updates-file", help="JSONL с записанными апдейтами (по одному на строку)")
+    p.set_defaults(func=bench_ingress)
+    p = sub.add_parser("overview", help="/stats и admin_chats: полный обход против ChatIndex")
+    p.add_argument("--chats", type=int, default=50000)
+    p.add_argument("--repeat", type=int, default=20)
+    p.set_defaults(func=bench_overview)
+    p = sub.add_parser("rescan", help="Фоновая сверка админов по всем чатам против фейкового API")
+    p.add_argument("--chats", type=int, default=500)
+    p.add_argument("--concurrency", type=int, default=bot.RESCAN_CONCURRENCY)
+    p.add_argument("--jitter", type=float, default=0.01)
+    p.add_argument("--latency", type=float, default=0.05)
+    p.add_argument("--global-rate", type=float, default=bot.API_GLOBAL_RATE)
+    p.add_argument("--kicked", type=float, default=0.05)
+    p.add_argument("--no-rights", type=float, default=0.05)
+    p.set_defaults(func=bench_rescan)
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -1,88 +1,1721 @@
+import bisect
 import logging
 import json
 import os
 import re
+import sqlite3
+import tempfile
+import threading
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping
 from datetime import datetime
-from typing import Dict, Set
+from itertools import islice
+from queue import Empty
+from typing import Dict, Iterable, List, NamedTuple, Set, Tuple
 import asyncio
+import functools
+import hashlib
+import heapq
+import hmac
+import itertools
+import multiprocessing
+import random
+import secrets
+import signal
+import time
+from multiprocessing.managers import SyncManager
+from urllib.parse import urlsplit
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ChatMember
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, ChatMember, MessageEntity
+from telegram.ext import Application, BaseUpdateProcessor, ChatMemberHandler, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
 from telegram.constants import ChatMemberStatus
-from telegram.error import BadRequest
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
 
 # Настройки
 ADMIN_ID = 946695591
 BOT_TOKEN = os.getenv('BOT_TOKEN')
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '16'))
+# SHARDS > 1: один процесс принимает апдейты и раздаёт их по chat_id процессам-шардам
+SHARDS = int(os.getenv('SHARDS', '1'))
+SHARD_POLL_TIMEOUT = 30
+SHARDS_FILE = "shards.json"
+SHARD_WATCH_INTERVAL = 5
+# Задан WEBHOOK_URL — апдейты принимает свой HTTP-сервер вместо long polling
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH') or urlsplit(WEBHOOK_URL).path or '/'
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000'))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+INGRESS_MODE = 'webhook' if WEBHOOK_URL else 'polling'
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-chat_data = {}
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "total", "count")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.total += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+class Metrics:
+    # Счётчики и гистограммы в памяти процесса, отдаются в текстовом формате Prometheus.
+    # Метки передаются именованными аргументами: metrics.inc("x_total", rule="casino")
+    def __init__(self):
+        self.counters: Dict[Tuple[str, tuple], float] = {}
+        self.histograms: Dict[Tuple[str, tuple], Histogram] = {}
+        self.gauges: Dict[str, object] = {}
+        self.counter_callbacks: Dict[str, object] = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    def gauge(self, name: str, callback):
+        self.gauges[name] = callback
+
+    def counter(self, name: str, callback):
+        # Счётчик, который ведёт сам компонент (попадания кэша и т.п.): значение только растёт
+        self.counter_callbacks[name] = callback
+
+    @staticmethod
+    def _labels(labels, extra=()) -> str:
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+    def render(self) -> str:
+        lines = []
+        for name in sorted({name for name, _ in self.counters}):
+            lines.append(f"# TYPE {name} counter")
+            for (n, labels), value in self.counters.items():
+                if n == name:
+                    lines.append(f"{name}{self._labels(labels)} {value}")
+        for name in sorted({name for name, _ in self.histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (n, labels), histogram in self.histograms.items():
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {histogram.count}")
+                lines.append(f"{name}_sum{self._labels(labels)} {histogram.total}")
+                lines.append(f"{name}_count{self._labels(labels)} {histogram.count}")
+        for kind, callbacks in (("counter", self.counter_callbacks), ("gauge", self.gauges)):
+            for name, callback in sorted(callbacks.items()):
+                try:
+                    value = callback()
+                except Exception as e:
+                    logger.warning(f"Метрика {name}: {e}")
+                    continue
+                lines.append(f"# TYPE {name} {kind}")
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+class timed:
+    # with timed("save_seconds"): ... — пишет длительность блока в гистограмму
+    __slots__ = ("name", "labels", "started")
+
+    def __init__(self, name: str, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        metrics.observe(self.name, time.perf_counter() - self.started, **self.labels)
+        return False
+
+async def read_http_request(reader: asyncio.StreamReader, max_body: int = 1 << 20):
+    request_line = await reader.readline()
+    parts = request_line.decode('latin-1').split()
+    if len(parts) < 2:
+        raise ValueError("bad request line")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        key, _, value = line.decode('latin-1').partition(':')
+        headers[key.strip().lower()] = value.strip()
+    length = int(headers.get('content-length') or 0)
+    if length > max_body:
+        raise ValueError("body too large")
+    body = await reader.readexactly(length) if length else b''
+    return parts[0], parts[1], headers, body
+
+def write_http_response(writer: asyncio.StreamWriter, status: str, body: bytes = b'',
+                        content_type: str = 'text/plain; charset=utf-8'):
+    writer.write(
+        f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+        f"Connection: close\r\n\r\n".encode('latin-1') + body
+    )
+
+async def handle_metrics_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        method, path, _, _ = await read_http_request(reader)
+        if method == 'GET' and path.split('?')[0] == '/metrics':
+            write_http_response(writer, '200 OK', metrics.render().encode('utf-8'),
+                                'text/plain; version=0.0.4; charset=utf-8')
+        else:
+            write_http_response(writer, '404 Not Found', b'not found\n')
+        await writer.drain()
+    except Exception as e:
+        logger.warning(f"Метрики: {e}")
+    finally:
+        writer.close()
+
+async def start_metrics_server(host: str, port: int):
+    server = await asyncio.start_server(handle_metrics_request, host, port)
+    logger.info(f"Метрики: http://{host}:{port}/metrics")
+    return server
+
+class WebhookIntake:
+    # Приём апдейтов по HTTP. Запрос без правильного секрета отклоняется, принятый апдейт
+    # сразу получает 200, а обработка идёт в фоне. Необработанных апдейтов не больше limit:
+    # сверх него отвечаем 503, и Telegram повторит доставку позже, не раздувая память.
+    def __init__(self, sink, path: str, secret: str, limit: int, backlog=None):
+        self.sink = sink
+        self.path = path
+        self.secret = secret
+        self.limit = limit
+        self.backlog = backlog
+        self.pending = 0
+        self._tasks = set()
+
+    def full(self) -> bool:
+        return self.pending >= self.limit or (self.backlog is not None and self.backlog() >= self.limit)
+
+    def accept(self, method: str, path: str, headers, body: bytes) -> str:
+        if method != 'POST' or path.split('?')[0] != self.path:
+            return '404 Not Found'
+        if not hmac.compare_digest(headers.get('x-telegram-bot-api-secret-token', ''), self.secret):
+            return '403 Forbidden'
+        if self.full():
+            return '503 Service Unavailable'
+        data = json.loads(body)
+        # Задачи стартуют в порядке приёма, поэтому sink видит апдейты в том же порядке
+        self.pending += 1
+        task = asyncio.create_task(self._deliver(data))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return '200 OK'
+
+    async def _deliver(self, data):
+        try:
+            await self.sink(data)
+        except Exception as e:
+            logger.error(f"Webhook: ошибка обработки апдейта: {e}")
+        finally:
+            self.pending -= 1
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            try:
+                status = self.accept(*await read_http_request(reader))
+            except (ValueError, asyncio.IncompleteReadError):
+                status = '400 Bad Request'
+            metrics.inc("webhook_requests_total", status=status.split()[0])
+            write_http_response(writer, status)
+            await writer.drain()
+        except Exception as e:
+            logger.warning(f"Webhook: {e}")
+        finally:
+            writer.close()
+
+    async def start(self, host: str, port: int):
+        return await asyncio.start_server(self.handle, host, port)
+
+    async def drain(self):
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
 DATA_FILE = "bot_data.json"
+DB_FILE = "bot_data.db"
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'json')
+SAVE_INTERVAL = float(os.getenv('SAVE_INTERVAL', '5'))
+
+class ChatState:
+    # Состояние чата. tracked = (bots | manual_bots) - ignored_bots поддерживается
+    # при каждом изменении, поэтому наборы меняются только через методы ниже.
+    # Об изменении числа ботов и удалений сообщается в ChatIndex через notify.
+    __slots__ = ("bots", "manual_bots", "ignored_bots", "tracked", "deleted", "notify")
+
+    def __init__(self, bots=(), manual_bots=(), ignored_bots=(), deleted: int = 0):
+        self.bots = set(bots)
+        self.manual_bots = set(manual_bots)
+        self.ignored_bots = set(ignored_bots)
+        self.deleted = deleted
+        self.notify = None
+        self._rebuild()
+
+    def _rebuild(self):
+        self.tracked = (self.bots | self.manual_bots) - self.ignored_bots
+
+    def _changed(self):
+        if self.notify is not None:
+            self.notify(self)
+
+    def add_bot(self, bot_id: int) -> bool:
+        if bot_id in self.bots:
+            return False
+        self.bots.add(bot_id)
+        if bot_id not in self.ignored_bots:
+            self.tracked.add(bot_id)
+        self._changed()
+        return True
+
+    def add_manual(self, bot_id: int):
+        self.manual_bots.add(bot_id)
+        self.ignored_bots.discard(bot_id)
+        self.tracked.add(bot_id)
+        self._changed()
+
+    def ignore(self, bot_id: int):
+        self.ignored_bots.add(bot_id)
+        self.bots.discard(bot_id)
+        self.manual_bots.discard(bot_id)
+        self.tracked.discard(bot_id)
+        self._changed()
+
+    def set_bots(self, bot_ids):
+        self.bots = set(bot_ids)
+        self._rebuild()
+        self._changed()
+
+    def record_deletion(self):
+        self.deleted += 1
+        self._changed()
+
+    def is_listed(self, bot_id: int) -> bool:
+        return bot_id in self.bots or bot_id in self.manual_bots
+
+    def bot_count(self) -> int:
+        return len(self.bots) + len(self.manual_bots)
+
+    @classmethod
+    def from_lists(cls, info):
+        return cls(info.get("bots", []), info.get("manual_bots", []), info.get("ignored_bots", []),
+                   info.get("deleted", 0))
+
+    def to_lists(self):
+        return {
+            "bots": list(self.bots),
+            "manual_bots": list(self.manual_bots),
+            "ignored_bots": list(self.ignored_bots),
+            "deleted": self.deleted
+        }
+
+    def to_row(self, chat_id: int):
+        return (chat_id, json.dumps(list(self.bots)), json.dumps(list(self.manual_bots)),
+                json.dumps(list(self.ignored_bots)), self.deleted)
+
+def write_json_atomic(path: str, data) -> int:
+    payload = json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8')
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path), suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    return len(payload)
+
+class JsonStorage:
+    # Весь файл читается при старте и целиком переписывается при каждом сохранении
+    def __init__(self, path: str):
+        self.path = path
+
+    def load_index(self):
+        chats = {}
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for chat_id, info in json.load(f).items():
+                    chats[int(chat_id)] = ChatState.from_lists(info)
+        return {chat_id: (state.bot_count(), state.deleted) for chat_id, state in chats.items()}, chats
+
+    def load_chat(self, chat_id: int):
+        return None
+
+    def snapshot(self, chats, dirty):
+        return {str(chat_id): state.to_lists() for chat_id, state in chats.loaded_items()}
+
+    def write(self, snapshot) -> int:
+        return write_json_atomic(self.path, snapshot)
+
+    def close(self):
+        pass
+
+class SqliteStorage:
+    # Одна строка на чат: изменение чата — один upsert, чаты подгружаются при первом обращении
+    def __init__(self, path: str):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db_lock = threading.Lock()
+        with self._db_lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS chats ("
+                "chat_id INTEGER PRIMARY KEY, bots TEXT NOT NULL, "
+                "manual_bots TEXT NOT NULL, ignored_bots TEXT NOT NULL, deleted INTEGER NOT NULL DEFAULT 0)"
+            )
+            columns = {row[1] for row in self._db.execute("PRAGMA table_info(chats)")}
+            if "deleted" not in columns:
+                self._db.execute("ALTER TABLE chats ADD COLUMN deleted INTEGER NOT NULL DEFAULT 0")
+            self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        # Ленивые загрузки читают через своё соединение: в WAL чтение не ждёт запись DataSaver
+        self._reader = sqlite3.connect(path, check_same_thread=False)
+        self._reader_lock = threading.Lock()
+
+    def load_index(self):
+        # Сами наборы не читаем: для агрегатов хватает их длины
+        with self._db_lock:
+            summary = {row[0]: (row[1], row[2]) for row in self._db.execute(
+                "SELECT chat_id, json_array_length(bots) + json_array_length(manual_bots), deleted FROM chats"
+            )}
+        return summary, {}
+
+    def load_chat(self, chat_id: int):
+        with self._reader_lock:
+            row = self._reader.execute(
+                "SELECT bots, manual_bots, ignored_bots, deleted FROM chats WHERE chat_id = ?", (chat_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return ChatState(json.loads(row[0]), json.loads(row[1]), json.loads(row[2]), row[3])
+
+    def snapshot(self, chats, dirty):
+        rows = []
+        for chat_id in dirty:
+            state = chats.loaded_get(chat_id)
+            if state is not None:
+                rows.append(state.to_row(chat_id))
+        return rows
+
+    def write(self, rows) -> int:
+        if not rows:
+            return 0
+        with self._db_lock, self._db:
+            self._db.executemany(
+                "INSERT INTO chats (chat_id, bots, manual_bots, ignored_bots, deleted) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(chat_id) DO UPDATE SET bots = excluded.bots, "
+                "manual_bots = excluded.manual_bots, ignored_bots = excluded.ignored_bots, deleted = excluded.deleted",
+                rows
+            )
+        return sum(len(row[1]) + len(row[2]) + len(row[3]) for row in rows)
+
+    def is_migrated(self) -> bool:
+        with self._db_lock:
+            return self._db.execute("SELECT 1 FROM meta WHERE key = 'migrated_from_json'").fetchone() is not None
+
+    def migrate_from_json(self, json_path: str) -> int:
+        _, chats = JsonStorage(json_path).load_index()
+        rows = [state.to_row(chat_id) for chat_id, state in chats.items()]
+        with self._db_lock, self._db:
+            self._db.executemany(
+                "INSERT OR IGNORE INTO chats (chat_id, bots, manual_bots, ignored_bots, deleted) VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+            self._db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('migrated_from_json', ?)",
+                (datetime.now().isoformat(),)
+            )
+        return len(rows)
+
+    def close(self):
+        with self._db_lock:
+            self._db.close()
+        with self._reader_lock:
+            self._reader.close()
+
+class ChatIndex:
+    # Агрегаты по всем чатам, включая ещё не загруженные: число ботов и удалений на чат,
+    # суммы, корзины чатов по числу ботов для топа и отсортированный список ID для
+    # постраничного вывода. ChatState сообщает о каждом изменении, обхода chat_data нет.
+    def __init__(self):
+        self.counts: Dict[int, int] = {}
+        self.deleted: Dict[int, int] = {}
+        self.total_bots = 0
+        self.total_deleted = 0
+        self._buckets: Dict[int, Set[int]] = {}
+        self._levels: List[int] = []
+        self._ids: List[int] = []
+
+    def rebuild(self, summary):
+        self.__init__()
+        for chat_id, (count, deleted) in summary.items():
+            self.counts[chat_id] = count
+            self.deleted[chat_id] = deleted
+            self.total_bots += count
+            self.total_deleted += deleted
+            self._enter(count, chat_id)
+        self._ids = sorted(self.counts)
+
+    def _enter(self, count: int, chat_id: int):
+        bucket = self._buckets.get(count)
+        if bucket is None:
+            bucket = self._buckets[count] = set()
+            bisect.insort(self._levels, count)
+        bucket.add(chat_id)
+
+    def _leave(self, count: int, chat_id: int):
+        bucket = self._buckets[count]
+        bucket.discard(chat_id)
+        if not bucket:
+            del self._buckets[count]
+            del self._levels[bisect.bisect_left(self._levels, count)]
+
+    def update(self, chat_id: int, count: int, deleted: int):
+        old = self.counts.get(chat_id)
+        old_deleted = self.deleted.get(chat_id, 0)
+        if old == count and old_deleted == deleted:
+            return
+        if old is None:
+            bisect.insort(self._ids, chat_id)
+        if old != count:
+            if old is not None:
+                self._leave(old, chat_id)
+            self._enter(count, chat_id)
+        self.total_bots += count - (old or 0)
+        self.total_deleted += deleted - old_deleted
+        self.counts[chat_id] = count
+        self.deleted[chat_id] = deleted
+
+    def update_state(self, chat_id: int, state: ChatState):
+        self.update(chat_id, state.bot_count(), state.deleted)
+
+    def remove(self, chat_id: int):
+        count = self.counts.pop(chat_id, None)
+        if count is None:
+            return
+        self._leave(count, chat_id)
+        del self._ids[bisect.bisect_left(self._ids, chat_id)]
+        self.total_bots -= count
+        self.total_deleted -= self.deleted.pop(chat_id)
+
+    def top(self, k: int) -> List[Tuple[int, int]]:
+        result = []
+        for level in reversed(self._levels):
+            result.extend((chat_id, level) for chat_id in islice(self._buckets[level], k - len(result)))
+            if len(result) >= k:
+                break
+        return result
+
+    def rows(self, after=None, limit: int = None) -> List[Tuple[int, int, int]]:
+        # (chat_id, ботов, удалено) по возрастанию chat_id, начиная строго после after
+        start = 0 if after is None else bisect.bisect_right(self._ids, after)
+        ids = self._ids[start:] if limit is None else self._ids[start:start + limit]
+        return [(chat_id, self.counts[chat_id], self.deleted[chat_id]) for chat_id in ids]
+
+    def __len__(self):
+        return len(self.counts)
+
+class ChatRegistry(MutableMapping):
+    # Словарь chat_id -> данные чата поверх хранилища: известны все ID, а сами данные
+    # читаются из хранилища только при первом обращении к чату
+    def __init__(self):
+        self.storage = None
+        self.index = ChatIndex()
+        self._known: Set[int] = set()
+        self._loaded: Dict[int, dict] = {}
+
+    def attach(self, storage):
+        self.storage = storage
+        summary, self._loaded = storage.load_index()
+        self._known = set(summary)
+        self.index.rebuild(summary)
+        for chat_id, state in self._loaded.items():
+            self._watch(chat_id, state)
+
+    def _watch(self, chat_id: int, state: ChatState):
+        state.notify = functools.partial(self.index.update_state, chat_id)
+
+    def __contains__(self, chat_id):
+        return chat_id in self._known
+
+    def _install(self, chat_id: int, state):
+        if state is None:
+            state = ChatState()
+        self._loaded[chat_id] = state
+        self._watch(chat_id, state)
+        self.index.update_state(chat_id, state)
+        return state
+
+    def __getitem__(self, chat_id):
+        state = self._loaded.get(chat_id)
+        if state is not None:
+            return state
+        if chat_id not in self._known:
+            raise KeyError(chat_id)
+        return self._install(chat_id, self.storage.load_chat(chat_id) if self.storage else None)
+
+    async def load(self, chat_id):
+        # Как get, но чтение из хранилища идёт в потоке и не останавливает event loop
+        state = self._loaded.get(chat_id)
+        if state is not None or chat_id not in self._known:
+            return state
+        stored = await asyncio.to_thread(self.storage.load_chat, chat_id) if self.storage else None
+        # Пока читали, чат мог загрузить другой обработчик или его могли удалить
+        state = self._loaded.get(chat_id)
+        if state is not None or chat_id not in self._known:
+            return state
+        return self._install(chat_id, stored)
+
+    def get(self, chat_id, default=None):
+        state = self._loaded.get(chat_id)
+        if state is not None:
+            return state
+        if chat_id not in self._known:
+            return default
+        return self[chat_id]
+
+    def __setitem__(self, chat_id, state):
+        self._known.add(chat_id)
+        self._loaded[chat_id] = state
+        self._watch(chat_id, state)
+        self.index.update_state(chat_id, state)
+
+    def __delitem__(self, chat_id):
+        self._known.remove(chat_id)
+        self._loaded.pop(chat_id, None)
+        self.index.remove(chat_id)
+
+    def __iter__(self):
+        return iter(list(self._known))
+
+    def __len__(self):
+        return len(self._known)
+
+    def loaded_get(self, chat_id):
+        return self._loaded.get(chat_id)
+
+    def loaded_items(self):
+        return self._loaded.items()
+
+    def clear(self):
+        self._known = set()
+        self._loaded = {}
+        self.index.rebuild({})
+
+chat_data = ChatRegistry()
+
+def make_storage(backend: str):
+    if backend == 'sqlite':
+        storage = SqliteStorage(DB_FILE)
+        if not storage.is_migrated() and os.path.exists(DATA_FILE):
+            count = storage.migrate_from_json(DATA_FILE)
+            logger.info(f"Перенесено чатов из {DATA_FILE} в {DB_FILE}: {count}")
+        return storage
+    return JsonStorage(DATA_FILE)
 
 def load_data():
-    global chat_data
     try:
-        if os.path.exists(DATA_FILE):
-            with open(DATA_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                for chat_id, info in data.items():
-                    chat_data[int(chat_id)] = {
-                        "bots": set(info.get("bots", [])),
-                        "manual_bots": set(info.get("manual_bots", [])),
-                        "ignored_bots": set(info.get("ignored_bots", []))
-                    }
+        chat_data.attach(make_storage(STORAGE_BACKEND))
     except Exception as e:
         logger.error(f"Ошибка загрузки: {e}")
-        chat_data = {}
+        chat_data.clear()
+
+class DataSaver:
+    # Отложенная запись: обработчики только помечают чат изменённым, а фоновая задача
+    # раз в interval секунд сбрасывает изменения в хранилище вне event loop.
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.dirty: Set[int] = set()
+        self._task = None
+        self._lock = asyncio.Lock()
+
+    def mark_dirty(self, chat_id: int):
+        self.dirty.add(chat_id)
+
+    async def flush(self, force: bool = False):
+        async with self._lock:
+            if not self.dirty and not force:
+                return
+            dirty, self.dirty = self.dirty, set()
+            # Снимок собираем на event loop, пока наборы никто не меняет; сериализация и диск — в потоке
+            storage = chat_data.storage
+            started = time.perf_counter()
+            data = storage.snapshot(chat_data, dirty)
+            try:
+                written = await asyncio.to_thread(storage.write, data)
+            except Exception as e:
+                self.dirty |= dirty
+                metrics.inc("save_errors_total")
+                logger.error(f"Ошибка сохранения: {e}")
+                return
+            metrics.observe("save_seconds", time.perf_counter() - started)
+            metrics.inc("save_bytes_total", written)
+            metrics.inc("save_chats_total", len(dirty))
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        if chat_data.storage is not None:
+            chat_data.storage.close()
+
+data_saver = DataSaver(SAVE_INTERVAL)
+
+def mark_dirty(chat_id: int):
+    data_saver.mark_dirty(chat_id)
+
+API_GLOBAL_RATE = float(os.getenv('API_GLOBAL_RATE', '30'))
+API_CHAT_RATE = float(os.getenv('API_CHAT_RATE', '1'))
+API_CHAT_BURST = 20
+API_MAX_RETRIES = 3
+API_SCAN_DEPTH = 50
+API_STOP_TIMEOUT = 10
+PRIORITY_DELETE = 0
+PRIORITY_NOTICE = 1
+PRIORITY_LOOKUP = 2
+PRIORITY_NAMES = ("delete", "notice", "lookup")
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def wait_time(self, now: float) -> float:
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+class ApiRequest:
+    __slots__ = ("priority", "chat_id", "factory", "future", "retries", "attempt")
+
+    def __init__(self, priority: int, chat_id, factory, future, retries: int):
+        self.priority = priority
+        self.chat_id = chat_id
+        self.factory = factory
+        self.future = future
+        self.retries = retries
+        self.attempt = 0
+
+class ApiScheduler:
+    # Все исходящие вызовы Telegram API идут через общую очередь с приоритетами
+    # (удаления раньше уведомлений и get_chat) и токен-бакетами: глобальным и на чат.
+    # RetryAfter приостанавливает чат (или всех) на retry_after, запрос повторяется.
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: float):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._queues = [deque() for _ in range(PRIORITY_LOOKUP + 1)]
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self._inflight: Set[asyncio.Task] = set()
+        self.throttled = 0
+        self.flood_waits = 0
+        self.retries = 0
+        self.failed = 0
+        self.sent = 0
+
+    def depth(self) -> int:
+        return sum(len(queue) for queue in self._queues)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queue": self.depth(),
+            "sent": self.sent,
+            "throttled": self.throttled,
+            "flood_waits": self.flood_waits,
+            "retries": self.retries,
+            "failed": self.failed,
+        }
+
+    async def call(self, priority: int, chat_id, factory, retries: int = 0):
+        # factory создаёт новую корутину на каждую попытку
+        if self._task is None:
+            return await factory()
+        request = ApiRequest(priority, chat_id, factory, asyncio.get_running_loop().create_future(), retries)
+        self._queues[priority].append(request)
+        self._wakeup.set()
+        return await request.future
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _next_ready(self, now: float):
+        # Возвращает (запрос, 0) или (None, сколько ждать до ближайшего готового)
+        wait = self.global_bucket.wait_time(now)
+        if wait > 0:
+            return None, wait
+        wait = float('inf')
+        for queue in self._queues:
+            for index, request in enumerate(queue):
+                if index >= API_SCAN_DEPTH:
+                    break
+                if request.chat_id is None:
+                    del queue[index]
+                    return request, 0.0
+                chat_wait = self._chat_bucket(request.chat_id).wait_time(now)
+                if chat_wait <= 0:
+                    del queue[index]
+                    return request, 0.0
+                wait = min(wait, chat_wait)
+        return None, wait
 
-def save_data():
+    async def _execute(self, request: ApiRequest):
+        request.attempt += 1
+        try:
+            with timed("api_request_seconds", priority=PRIORITY_NAMES[request.priority]):
+                result = await request.factory()
+        except asyncio.CancelledError:
+            request.future.cancel()
+            raise
+        except RetryAfter as e:
+            self.flood_waits += 1
+            metrics.inc("api_flood_waits_total")
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+            bucket = self.global_bucket if request.chat_id is None else self._chat_bucket(request.chat_id)
+            bucket.blocked_until = max(bucket.blocked_until, time.monotonic() + retry_after)
+            if request.attempt <= request.retries:
+                self.retries += 1
+                self._queues[request.priority].appendleft(request)
+                self._wakeup.set()
+                return
+            self.failed += 1
+            metrics.inc("api_errors_total", type="RetryAfter")
+            if not request.future.done():
+                request.future.set_exception(e)
+        except Exception as e:
+            self.failed += 1
+            metrics.inc("api_errors_total", type=type(e).__name__)
+            if not request.future.done():
+                request.future.set_exception(e)
+        else:
+            self.sent += 1
+            if not request.future.done():
+                request.future.set_result(result)
+
+    async def _run(self):
+        while True:
+            if not self.depth():
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            request, wait = self._next_ready(time.monotonic())
+            if request is None:
+                self.throttled += 1
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), min(wait, 1.0))
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+            self.global_bucket.take()
+            if request.chat_id is not None:
+                self._chat_bucket(request.chat_id).take()
+            # Ссылку держим сами: на задачу без ссылок event loop хранит только слабую
+            task = asyncio.create_task(self._execute(request))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Запросы, уже ушедшие в API, дожидаемся; повисшие дольше API_STOP_TIMEOUT отменяем
+        if self._inflight:
+            _, pending = await asyncio.wait(set(self._inflight), timeout=API_STOP_TIMEOUT)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+        for queue in self._queues:
+            while queue:
+                request = queue.popleft()
+                if not request.future.done():
+                    request.future.cancel()
+
+api_scheduler = ApiScheduler(API_GLOBAL_RATE, API_CHAT_RATE, API_CHAT_BURST)
+
+NOTICE_TTL = 5
+DELETIONS_FILE = "pending_deletions.json"
+DELETE_BATCH_SIZE = 100
+DELETE_COALESCE = 1.0
+# Уведомление живёт NOTICE_TTL секунд — на диск оно должно попасть заметно раньше
+DELETIONS_SAVE_DELAY = 1.0
+
+async def delete_messages_bulk(bot, chat_id: int, message_ids: List[int], priority: int = PRIORITY_NOTICE):
+    def delete_one(message_id: int):
+        return api_scheduler.call(priority, chat_id, lambda: bot.delete_message(chat_id, message_id),
+                                  retries=API_MAX_RETRIES)
+
+    for start in range(0, len(message_ids), DELETE_BATCH_SIZE):
+        batch = message_ids[start:start + DELETE_BATCH_SIZE]
+        try:
+            if len(batch) == 1:
+                await delete_one(batch[0])
+            elif hasattr(bot, 'delete_messages'):
+                await api_scheduler.call(priority, chat_id, lambda: bot.delete_messages(chat_id, batch),
+                                         retries=API_MAX_RETRIES)
+            else:
+                # deleteMessages появился в Bot API 7.0, в PTB 20.7 для него нет метода
+                await api_scheduler.call(priority, chat_id,
+                                         lambda: bot._post('deleteMessages', {"chat_id": chat_id, "message_ids": batch}),
+                                         retries=API_MAX_RETRIES)
+        except BadRequest as e:
+            logger.warning(f"Пакетное удаление в {chat_id} не удалось ({e.message}), удаляю по одному")
+            for message_id in batch:
+                try:
+                    await delete_one(message_id)
+                except BadRequest:
+                    pass
+
+class DeletionScheduler:
+    # Очередь отложенных удалений (куча по времени истечения). Хранится в файле,
+    # поэтому уведомления, не удалённые до перезапуска, удаляются после него.
+    # Файл переписывается не на каждое уведомление: изменения за save_delay секунд
+    # пишутся одной записью, не позже чем через save_delay после schedule().
+    def __init__(self, path: str, coalesce: float = DELETE_COALESCE, save_delay: float = DELETIONS_SAVE_DELAY):
+        self.path = path
+        self.coalesce = coalesce
+        self.save_delay = save_delay
+        self.bot = None
+        self._heap: List[Tuple[float, int, int]] = []
+        self._wakeup = asyncio.Event()
+        self._changed = asyncio.Event()
+        self._task = None
+        self._saver = None
+        self._dirty = False
+        self._save_lock = asyncio.Lock()
+
+    def load(self):
+        try:
+            if os.path.exists(self.path):
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self._heap = [(float(due), int(chat_id), int(message_id)) for due, chat_id, message_id in json.load(f)]
+                heapq.heapify(self._heap)
+        except Exception as e:
+            logger.error(f"Ошибка загрузки очереди удалений: {e}")
+            self._heap = []
+
+    async def _save(self):
+        async with self._save_lock:
+            if not self._dirty:
+                return
+            self._dirty = False
+            try:
+                await asyncio.to_thread(write_json_atomic, self.path, list(self._heap))
+            except Exception as e:
+                self._mark_dirty()
+                logger.error(f"Ошибка сохранения очереди удалений: {e}")
+
+    def _mark_dirty(self):
+        self._dirty = True
+        self._changed.set()
+
+    async def _save_loop(self):
+        while True:
+            await self._changed.wait()
+            await asyncio.sleep(self.save_delay)
+            self._changed.clear()
+            await self._save()
+
+    async def schedule(self, chat_id: int, message_id: int, ttl: float):
+        heapq.heappush(self._heap, (time.time() + ttl, chat_id, message_id))
+        self._mark_dirty()
+        self._wakeup.set()
+
+    def pending(self) -> int:
+        return len(self._heap)
+
+    async def _run(self):
+        while True:
+            if not self._heap:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                continue
+            # Уведомления, истекающие в ближайшие coalesce секунд, забираем вместе с
+            # истёкшими: отправленные подряд в один чат уйдут одним deleteMessages
+            horizon = time.time() + self.coalesce
+            popped = []
+            while self._heap and self._heap[0][0] <= horizon:
+                popped.append(heapq.heappop(self._heap))
+            due: Dict[int, List[int]] = {}
+            for _, chat_id, message_id in popped:
+                due.setdefault(chat_id, []).append(message_id)
+            self._mark_dirty()
+            try:
+                await asyncio.gather(*(self._delete(chat_id, message_ids) for chat_id, message_ids in due.items()))
+            except asyncio.CancelledError:
+                # Остановка посреди удаления: забранные записи возвращаем в кучу, чтобы stop()
+                # сохранил их и после перезапуска они удалились повторно (лишний delete безвреден)
+                for entry in popped:
+                    heapq.heappush(self._heap, entry)
+                self._mark_dirty()
+                raise
+
+    async def _delete(self, chat_id: int, message_ids: List[int]):
+        try:
+            await delete_messages_bulk(self.bot, chat_id, message_ids)
+        except Exception as e:
+            logger.error(f"Ошибка удаления уведомлений в {chat_id}: {e}")
+
+    def start(self, bot):
+        self.bot = bot
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            self._saver = asyncio.create_task(self._save_loop())
+
+    async def stop(self):
+        for task in (self._task, self._saver):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._task = self._saver = None
+        await self._save()
+
+deletion_scheduler = DeletionScheduler(DELETIONS_FILE)
+
+async def send_deletion_notice(bot, chat_id: int, username: str):
     try:
-        data_to_save = {}
-        for chat_id, info in chat_data.items():
-            data_to_save[str(chat_id)] = {
-                "bots": list(info["bots"]),
-                "manual_bots": list(info["manual_bots"]),
-                "ignored_bots": list(info["ignored_bots"])
-            }
-        with open(DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data_to_save, f, ensure_ascii=False, indent=2)
+        notification = await api_scheduler.call(
+            PRIORITY_NOTICE, chat_id, lambda: bot.send_message(chat_id, f"🚫 Удалена реклама от @{username}"))
+        await deletion_scheduler.schedule(chat_id, notification.message_id, NOTICE_TTL)
     except Exception as e:
-        logger.error(f"Ошибка сохранения: {e}")
+        logger.error(f"Ошибка уведомления в {chat_id}: {e}")
+
+PERMISSIONS_TTL = float(os.getenv('PERMISSIONS_TTL', '600'))
+
+class PermissionCache:
+    # Права самого бота по чатам. Живут PERMISSIONS_TTL секунд, но при изменении
+    # наших прав Telegram присылает my_chat_member, и запись обновляется сразу.
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._entries: Dict[int, Tuple[float, bool]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def set(self, chat_id: int, can_delete: bool) -> bool:
+        self._entries[chat_id] = (time.monotonic() + self.ttl, can_delete)
+        return can_delete
+
+    @staticmethod
+    def member_can_delete(member) -> bool:
+        return member.status == ChatMemberStatus.ADMINISTRATOR and bool(member.can_delete_messages)
+
+    def set_from_member(self, chat_id: int, member) -> bool:
+        return self.set(chat_id, self.member_can_delete(member))
+
+    def invalidate(self, chat_id: int):
+        self._entries.pop(chat_id, None)
+
+    async def can_delete(self, bot, chat_id: int) -> bool:
+        entry = self._entries.get(chat_id)
+        if entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        member = await bot.get_chat_member(chat_id, bot.id)
+        return self.set_from_member(chat_id, member)
+
+bot_permissions = PermissionCache(PERMISSIONS_TTL)
+
+ROSTER_TTL = float(os.getenv('ROSTER_TTL', '300'))
+ADMIN_STATUSES = (ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER)
+
+class AdminRoster:
+    # Администраторы чата одним get_chat_administrators на ROSTER_TTL секунд.
+    # Обновления chat_member правят список на месте, не дожидаясь истечения.
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._rosters: Dict[int, Tuple[float, Dict[int, ChatMember]]] = {}
+        self._inflight: Dict[int, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+
+    async def _fetch(self, bot, chat_id: int) -> Dict[int, ChatMember]:
+        return self.store(bot, chat_id, await bot.get_chat_administrators(chat_id))
+
+    def store(self, bot, chat_id: int, admins) -> Dict[int, ChatMember]:
+        roster = {admin.user.id: admin for admin in admins}
+        self._rosters[chat_id] = (time.monotonic() + self.ttl, roster)
+        # Заодно узнаём и свои права: бота нет среди админов — удалять он не может
+        me = roster.get(bot.id)
+        if me is not None:
+            bot_permissions.set_from_member(chat_id, me)
+        else:
+            bot_permissions.set(chat_id, False)
+        return roster
+
+    async def get(self, bot, chat_id: int) -> Dict[int, ChatMember]:
+        entry = self._rosters.get(chat_id)
+        if entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        # Одновременные запросы к одному чату ждут один и тот же вызов API
+        future = self._inflight.get(chat_id)
+        if future is None:
+            future = asyncio.ensure_future(self._fetch(bot, chat_id))
+            self._inflight[chat_id] = future
+            future.add_done_callback(lambda _: self._inflight.pop(chat_id, None))
+        return await asyncio.shield(future)
+
+    def apply_member(self, chat_id: int, member: ChatMember):
+        entry = self._rosters.get(chat_id)
+        if entry is None:
+            return
+        if member.status in ADMIN_STATUSES:
+            entry[1][member.user.id] = member
+        else:
+            entry[1].pop(member.user.id, None)
+
+    def invalidate(self, chat_id: int):
+        self._rosters.pop(chat_id, None)
+
+admin_rosters = AdminRoster(ROSTER_TTL)
+
+def bots_in_roster(roster: Dict[int, ChatMember], own_id: int) -> Set[int]:
+    return {
+        user_id for user_id, admin in roster.items()
+        if (admin.user.is_bot or is_bot_by_username(admin.user.username)) and user_id != own_id
+    }
+
+async def is_chat_admin(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int) -> bool:
+    try:
+        roster = await admin_rosters.get(context.bot, chat_id)
+    except BadRequest:
+        # Список админов недоступен (например, личный чат) — спрашиваем про пользователя напрямую
+        member = await context.bot.get_chat_member(chat_id, user_id)
+        return member.status in ADMIN_STATUSES
+    return user_id in roster
+
+RESCAN_INTERVAL = float(os.getenv('RESCAN_INTERVAL', '21600'))
+RESCAN_DELAY = 60
+RESCAN_CONCURRENCY = 4
+RESCAN_JITTER = 1.0
+RESCAN_MAX_API_QUEUE = 50
+
+class RosterRescanner:
+    # Фоновая сверка списков ботов с админами во всех группах: запросы идут через api_scheduler
+    # с низшим приоритетом, не больше concurrency сразу, со случайной паузой перед каждым и
+    # паузой, пока очередь API занята удалениями. Найденные боты-админы добавляются к bots;
+    # кого убрать, по списку админов не понять, поэтому удаление остаётся за /refreshbot.
+    # Сохраняются только изменившиеся чаты.
+    def __init__(self, interval: float, concurrency: int = RESCAN_CONCURRENCY, jitter: float = RESCAN_JITTER):
+        self.interval = interval
+        self.concurrency = concurrency
+        self.jitter = jitter
+        self.bot = None
+        self.last: Dict[str, float] = {}
+        self.runs = 0
+        self._task = None
+
+    async def _scan_chat(self, chat_id: int, result: Dict[str, list]):
+        bot = self.bot
+        await asyncio.sleep(random.uniform(0, self.jitter))
+        while api_scheduler.depth() > RESCAN_MAX_API_QUEUE:
+            await asyncio.sleep(1)
+        try:
+            admins = await api_scheduler.call(PRIORITY_LOOKUP, chat_id,
+                                              functools.partial(bot.get_chat_administrators, chat_id),
+                                              retries=API_MAX_RETRIES)
+        except (Forbidden, BadRequest) as e:
+            # Бота выгнали или чата больше нет
+            bot_permissions.set(chat_id, False)
+            admin_rosters.invalidate(chat_id)
+            result["removed"].append(chat_id)
+            logger.info(f"Сверка: чат {chat_id} недоступен: {e}")
+            return
+        except Exception as e:
+            result["errors"].append(chat_id)
+            logger.warning(f"Сверка: ошибка в {chat_id}: {e}")
+            return
+        roster = admin_rosters.store(bot, chat_id, admins)
+        me = roster.get(bot.id)
+        if me is None or not PermissionCache.member_can_delete(me):
+            result["lost_rights"].append(chat_id)
+        # Состояние чата грузится лениво — не поднимаем его из хранилища, если ботов-админов нет
+        found = bots_in_roster(roster, bot.id)
+        if not found:
+            return
+        state = await chat_data.load(chat_id)
+        if state is None:
+            return
+        found -= state.bots
+        if found:
+            state.set_bots(state.bots | found)
+            mark_dirty(chat_id)
+            result["changed"].append(chat_id)
+
+    async def _worker(self, chat_ids, result):
+        for chat_id in chat_ids:
+            await self._scan_chat(chat_id, result)
+
+    async def scan(self) -> Dict[str, float]:
+        started = time.perf_counter()
+        # Положительные ID — личные чаты, админов у них нет
+        chat_ids = sorted(chat_id for chat_id in chat_data if chat_id < 0)
+        scanned = len(chat_ids)
+        result = {"changed": [], "lost_rights": [], "removed": [], "errors": []}
+        # Воркеры разбирают общий итератор: в работе не больше concurrency чатов
+        chat_ids = iter(chat_ids)
+        await asyncio.gather(*(self._worker(chat_ids, result) for _ in range(self.concurrency)))
+        duration = time.perf_counter() - started
+        self.runs += 1
+        self.last = {"finished": time.time(), "seconds": duration, "chats": scanned,
+                     **{key: len(ids) for key, ids in result.items()}}
+        metrics.observe("rescan_seconds", duration)
+        metrics.inc("rescan_chats_changed_total", len(result["changed"]))
+        if result["lost_rights"]:
+            logger.warning(f"Сверка: нет права удалять в {len(result['lost_rights'])} чатах: {result['lost_rights'][:10]}")
+        logger.info(f"Сверка админов: {scanned} чатов за {duration:.1f} с, изменено {len(result['changed'])}, "
+                    f"без прав {len(result['lost_rights'])}, недоступно {len(result['removed'])}, "
+                    f"ошибок {len(result['errors'])}")
+        return self.last
+
+    async def _run(self):
+        await asyncio.sleep(min(RESCAN_DELAY, self.interval))
+        while True:
+            try:
+                await self.scan()
+            except Exception as e:
+                logger.error(f"Сверка админов прервана: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self, bot):
+        self.bot = bot
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+roster_rescanner = RosterRescanner(RESCAN_INTERVAL)
+
+NAME_CACHE_SIZE = 5000
+NAME_TTL = 3600
+NAME_NEGATIVE_TTL = 600
+NAME_LOOKUP_CONCURRENCY = 8
+
+class NameResolver:
+    # LRU-кэш ID -> (username, имя) с TTL. Заполняется и запросами get_chat, и
+    # попутно из отправителей, которых и так видит handle_message. Ненайденные ID
+    # тоже запоминаются (username и имя = None), чтобы не спрашивать их каждый раз.
+    def __init__(self, size: int, ttl: float, negative_ttl: float, concurrency: int):
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.concurrency = concurrency
+        self._cache: "OrderedDict[int, Tuple[float, object, object]]" = OrderedDict()
+
+    def _put(self, chat_id: int, username, name, ttl: float):
+        self._cache[chat_id] = (time.monotonic() + ttl, username, name)
+        self._cache.move_to_end(chat_id)
+        if len(self._cache) > self.size:
+            self._cache.popitem(last=False)
+
+    def remember(self, chat_or_user):
+        name = getattr(chat_or_user, 'first_name', None) or getattr(chat_or_user, 'title', None)
+        self._put(chat_or_user.id, chat_or_user.username, name, self.ttl)
+
+    def lookup(self, chat_id: int):
+        entry = self._cache.get(chat_id)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            del self._cache[chat_id]
+            return None
+        self._cache.move_to_end(chat_id)
+        return entry[1], entry[2]
+
+    async def resolve_many(self, bot, chat_ids: Iterable[int]) -> Dict[int, Tuple[object, object]]:
+        result = {}
+        missing = []
+        for chat_id in chat_ids:
+            entry = self.lookup(chat_id)
+            if entry is None:
+                missing.append(chat_id)
+            else:
+                result[chat_id] = entry
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def fetch(chat_id: int):
+            async with semaphore:
+                try:
+                    self.remember(await api_scheduler.call(PRIORITY_LOOKUP, None, lambda: bot.get_chat(chat_id)))
+                except (BadRequest, Forbidden):
+                    self._put(chat_id, None, None, self.negative_ttl)
+                except Exception as e:
+                    logger.warning(f"get_chat {chat_id}: {e}")
+                    return
+            result[chat_id] = self.lookup(chat_id)
+
+        await asyncio.gather(*(fetch(chat_id) for chat_id in missing))
+        return result
+
+name_resolver = NameResolver(NAME_CACHE_SIZE, NAME_TTL, NAME_NEGATIVE_TTL, NAME_LOOKUP_CONCURRENCY)
+
+def format_bot_name(bot_id: int, entry, with_at: bool = True) -> str:
+    username, first_name = entry or (None, None)
+    if username:
+        name = f"@{username}" if with_at else username
+    else:
+        name = first_name or str(bot_id)
+    if (username or first_name) and bot_id < 0:
+        name = f"Channel: {name}"
+    return name
+
+async def render_bot_list(bot, bot_ids) -> str:
+    names = await name_resolver.resolve_many(bot, bot_ids)
+    text = "🤖 Отслеживаемые боты:\n"
+    for i, bot_id in enumerate(bot_ids, 1):
+        text += f"{i}. {format_bot_name(bot_id, names.get(bot_id))} ({bot_id})\n"
+    return text
 
 def is_bot_by_username(username: str):
     if not username:
         return False
     return username.lower().endswith('bot')
 
-async def is_spam_message(text: str) -> bool:
-    if not text:
-        return False
-    text = text.lower()
-    spam_patterns = [
-        r'(подписыв|subscribe|join|присоедин)[^.]*(@|t\.me|telegram)',
-        r'(наш\s+канал|наша\s+группа|our\s+channel|our\s+group)',
-        r'(жми\s+|нажми\s+|click\s+|tap\s+).*(ссылк|link)',
-        r'(заработ|earn|profit|доход)[^.]*(\$|\d+|рубл|usd)',
-        r'(инвест|invest|вклад|депозит)[^.]*(\%|процент|profit)',
-        r'(бинарн|binary|опцион|trading|трейд)',
-        r'(казино|casino|ставк|bet|слот|slot)',
-        r'(выигр|win)[^.]*(\$|\d+.*рубл|\d+.*usd)',
-        r'(промо|promo|скидк|discount|код)[^.]*(\d+|\%)',
-        r'(акци|action|offer|предложени)',
-        r't\.me/[^/\s]+',
-        r'@[a-zA-Z0-9_]{5,}',
-        r'(бесплатн|free)[^.]*(\$|\d+|подарок|gift)',
-        r'(только\s+сегодня|today\s+only|ограничен|limited)',
-        r'(не\s+упусти|don\'t\s+miss|срочно|urgent)'
-    ]
-    spam_score = sum(1 for pattern in spam_patterns if re.search(pattern, text, re.IGNORECASE))
-    emoji_count = len(re.findall(r'[^\w\s]', text))
-    link_count = len(re.findall(r'(http|t\.me|@)', text))
-    if emoji_count > 10 or link_count > 2:
-        spam_score += 1
-    return spam_score >= 2
+# Правила: (имя, триггер, хвост). Каждое правило начинается со своего триггера,
+# поэтому текст без единого триггера гарантированно набирает 0 баллов.
+SPAM_RULES = (
+    ("subscribe", r'подписыв|subscribe|join|присоедин', r'[^.]*(@|t\.me|telegram)'),
+    ("our_channel", r'наш\s+канал|наша\s+группа|our\s+channel|our\s+group', r''),
+    ("click_link", r'жми\s+|нажми\s+|click\s+|tap\s+', r'.*(ссылк|link)'),
+    ("earn", r'заработ|earn|profit|доход', r'[^.]*(\$|\d+|рубл|usd)'),
+    ("invest", r'инвест|invest|вклад|депозит', r'[^.]*(\%|процент|profit)'),
+    ("trading", r'бинарн|binary|опцион|trading|трейд', r''),
+    ("casino", r'казино|casino|ставк|bet|слот|slot', r''),
+    ("win", r'выигр|win', r'[^.]*(\$|\d+.*рубл|\d+.*usd)'),
+    ("promo", r'промо|promo|скидк|discount|код', r'[^.]*(\d+|\%)'),
+    ("offer", r'акци|action|offer|предложени', r''),
+    ("tme_link", r't\.me/', r'[^/\s]+'),
+    ("mention", r'@', r'[a-zA-Z0-9_]{5,}'),
+    ("free", r'бесплатн|free', r'[^.]*(\$|\d+|подарок|gift)'),
+    ("limited", r'только\s+сегодня|today\s+only|ограничен|limited', r''),
+    ("urgent", r'не\s+упусти|don\'t\s+miss|срочно|urgent', r''),
+)
+SPAM_THRESHOLD = 2
+FLOOD_RULE = "flood"
+
+EMOJI_RE = re.compile(r'[^\w\s]')
+LINK_RE = re.compile(r'http|t\.me|@')
+
+class SpamVerdict(NamedTuple):
+    is_spam: bool
+    score: int
+    rules: Tuple[str, ...]
+
+# Правила, которые при наличии сущностей сообщения считаются по ним, а не регэкспом по тексту
+ENTITY_RULES = ("tme_link", "mention")
+TELEGRAM_LINK_HOSTS = ('t.me/', 'telegram.me/', 'telegram.dog/')
+UNICODE_EMOJI_RE = re.compile('[\U0001F000-\U0001FAFF\u2600-\u27BF\u2B00-\u2BFF]')
+
+class MessageFeatures(NamedTuple):
+    links: int
+    tme_links: int
+    hidden_links: int
+    mentions: int
+    emoji: int
+
+def is_telegram_link(url: str) -> bool:
+    url = url.lower()
+    return any(host in url for host in TELEGRAM_LINK_HOSTS)
+
+def extract_features(text: str, entities) -> MessageFeatures:
+    # Telegram уже разобрал ссылки и упоминания, в том числе text_link за обычными словами,
+    # которые регэксп по тексту не видит. Смещения сущностей — в единицах UTF-16.
+    links = tme_links = hidden_links = mentions = emoji = 0
+    encoded = None
+    for entity in entities or ():
+        kind = entity.type
+        if kind == MessageEntity.URL:
+            if encoded is None:
+                encoded = text.encode('utf-16-le')
+            url = encoded[entity.offset * 2:(entity.offset + entity.length) * 2].decode('utf-16-le', 'ignore')
+            links += 1
+            tme_links += is_telegram_link(url)
+        elif kind == MessageEntity.TEXT_LINK:
+            links += 1
+            hidden_links += 1
+            tme_links += is_telegram_link(entity.url or '')
+        elif kind == MessageEntity.MENTION:
+            mentions += 1
+        elif kind == MessageEntity.CUSTOM_EMOJI:
+            emoji += 1
+    # Обычные эмодзи сущностей не имеют; в ASCII-тексте их нет, regex можно не запускать
+    if text and not text.isascii():
+        emoji += len(UNICODE_EMOJI_RE.findall(text))
+    return MessageFeatures(links, tme_links, hidden_links, mentions, emoji)
+
+# Кэш отпечатков включается явно (FINGERPRINT_CACHE_SIZE=20000): выигрывает, только когда
+# кампании повторяют текст дословно; копии с правками он проверяет правилами заново
+FINGERPRINT_CACHE_SIZE = int(os.getenv('FINGERPRINT_CACHE_SIZE', '0'))
+FINGERPRINT_SKETCH_SIZE = 8
+FINGERPRINT_BANDS = 4
+FINGERPRINT_MIN_OVERLAP = 6
+FINGERPRINT_MIN_TOKENS = 6
+
+class FingerprintCache:
+    # Кэш вердиктов по отпечаткам текста, общий для всех чатов.
+    # Точное совпадение (хэш текста в нижнем регистре) запоминается и для спама, и для
+    # чистых текстов. Для спама дополнительно хранится MinHash-скетч (k наименьших хэшей
+    # слов): копия рекламы с мелкими правками совпадёт хотя бы в одной полосе скетча.
+    # Такое совпадение — только подсказка: SpamClassifier подтверждает на новом тексте
+    # правила кандидата.
+    def __init__(self, size: int, sketch_size: int = FINGERPRINT_SKETCH_SIZE, bands: int = FINGERPRINT_BANDS,
+                 min_overlap: int = FINGERPRINT_MIN_OVERLAP, min_tokens: int = FINGERPRINT_MIN_TOKENS):
+        self.size = size
+        self.band_width = sketch_size // bands
+        self.min_overlap = min_overlap
+        self.sketch_size = sketch_size
+        self.min_tokens = min_tokens
+        self._entries: "OrderedDict[bytes, Tuple[SpamVerdict, tuple]]" = OrderedDict()
+        self._bands: Dict[tuple, bytes] = {}
+        self.exact_hits = 0
+        self.near_hits = 0
+        self.near_rejected = 0
+        self.misses = 0
+
+    def sketch(self, text: str) -> tuple:
+        # Только чисто буквенные слова: числа, суммы и ссылки в копиях кампании меняются
+        hashes = set(map(hash, filter(str.isalpha, text.split())))
+        if len(hashes) < self.min_tokens:
+            return ()
+        return tuple(sorted(hashes)[:self.sketch_size])
+
+    def _band_keys(self, sketch: tuple):
+        # Полосы — все соседние окна скетча, ключ — только значения: лишнее слово с малым
+        # хэшем сдвигает позиции, но общие пары соседних хэшей остаются теми же
+        width = self.band_width
+        return [sketch[i:i + width] for i in range(len(sketch) - width + 1)]
+
+    def lookup(self, text: str, features: MessageFeatures = None):
+        # -> (вердикт, digest, скетч, похожее ли совпадение)
+        data = text.encode('utf-8')
+        if features is not None:
+            # Вердикт зависит и от сущностей: тот же текст со спрятанной ссылкой — другой ключ
+            data += repr(tuple(features)).encode()
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        entry = self._entries.get(digest)
+        if entry is not None:
+            self._entries.move_to_end(digest)
+            self.exact_hits += 1
+            return entry[0], digest, None, False
+        sketch = self.sketch(text)
+        if sketch:
+            for key in self._band_keys(sketch):
+                candidate_digest = self._bands.get(key)
+                candidate = self._entries.get(candidate_digest)
+                if candidate is not None and len(set(sketch) & set(candidate[1])) >= self.min_overlap:
+                    # Живая кампания не должна вытесняться из LRU, пока её копии приходят
+                    self._entries.move_to_end(candidate_digest)
+                    return candidate[0], digest, sketch, True
+        self.misses += 1
+        return None, digest, sketch, False
+
+    def store(self, digest: bytes, sketch: tuple, verdict: SpamVerdict):
+        if not verdict.is_spam:
+            sketch = ()
+        self._entries[digest] = (verdict, sketch)
+        self._entries.move_to_end(digest)
+        for key in self._band_keys(sketch) if sketch else ():
+            self._bands[key] = digest
+        while len(self._entries) > self.size:
+            old_digest, (_, old_sketch) = self._entries.popitem(last=False)
+            for key in self._band_keys(old_sketch) if old_sketch else ():
+                if self._bands.get(key) == old_digest:
+                    del self._bands[key]
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.exact_hits + self.near_hits + self.near_rejected + self.misses
+        return {
+            "entries": len(self._entries),
+            "exact_hits": self.exact_hits,
+            "near_hits": self.near_hits,
+            "near_rejected": self.near_rejected,
+            "misses": self.misses,
+            "hit_rate": (self.exact_hits + self.near_hits) / lookups if lookups else 0.0,
+        }
+
+class SpamClassifier:
+    # Строится один раз при старте. Все триггеры собраны в одну альтернацию без групп:
+    # на ней re включает быстрый поиск по литералам, и чистый текст отсекается за один
+    # проход. Полные правила проверяются только после срабатывания триггера.
+    def __init__(self, rules=SPAM_RULES, threshold: int = SPAM_THRESHOLD, cache: FingerprintCache = None):
+        self.threshold = threshold
+        self.rules = [(name, re.compile(f'({trigger}){tail}')) for name, trigger, tail in rules]
+        self.patterns = dict(self.rules)
+        self.trigger = re.compile('|'.join(f'(?:{trigger})' for _, trigger, _ in rules))
+        # Для сообщений с разобранными сущностями ссылки и упоминания берутся из них
+        self.text_rules = [(name, pattern) for name, pattern in self.rules if name not in ENTITY_RULES]
+        self.text_trigger = re.compile('|'.join(f'(?:{trigger})' for name, trigger, _ in rules
+                                                if name not in ENTITY_RULES))
+        self.entity_rules = [name for name, _, _ in rules if name in ENTITY_RULES]
+        self.cache = cache
+
+    def _flood(self, text: str) -> bool:
+        return len(LINK_RE.findall(text)) > 2 or len(EMOJI_RE.findall(text)) > 10
+
+    def _entity_hits(self, features: MessageFeatures) -> List[str]:
+        found = {"tme_link": features.tme_links, "mention": features.mentions}
+        return [name for name in self.entity_rules if found[name]]
+
+    def classify(self, text: str, features: MessageFeatures = None) -> SpamVerdict:
+        if not text:
+            return SpamVerdict(False, 0, ())
+        text = text.lower()
+        if features is None:
+            first = self.trigger.search(text)
+            triggered = first is not None
+        else:
+            first = self.text_trigger.search(text)
+            triggered = first is not None or features.tme_links or features.mentions
+        # Текст без единого триггера дешевле досчитать, чем искать в кэше
+        if not triggered or self.cache is None:
+            return self._score(text, first, features)
+        verdict, digest, sketch, near = self.cache.lookup(text, features)
+        if near:
+            if self._confirm(text, features, verdict):
+                self.cache.near_hits += 1
+                # Дословные повторы этого текста дальше пойдут по точному ключу, без проверки правил
+                self.cache.store(digest, (), verdict)
+            else:
+                # Похожий текст не подтвердил правила кандидата — досчитываем полностью
+                self.cache.near_rejected += 1
+                verdict = None
+        if verdict is None:
+            verdict = self._score(text, first, features)
+            self.cache.store(digest, sketch, verdict)
+        return verdict
+
+    def _flood_hit(self, text: str, features: MessageFeatures = None) -> bool:
+        if features is None:
+            return self._flood(text)
+        return features.links + features.mentions > 2 or features.emoji > 10
+
+    def _confirm(self, text: str, features: MessageFeatures, verdict: SpamVerdict) -> bool:
+        # Вердикт похожего текста принимается, только если все правила кандидата срабатывают
+        # и на этом тексте: отличия в ссылках, числах и сущностях скетч не видит
+        entity_hits = self._entity_hits(features) if features is not None else ()
+        for name in verdict.rules:
+            if name == FLOOD_RULE:
+                hit = self._flood_hit(text, features)
+            elif features is not None and name in ENTITY_RULES:
+                hit = name in entity_hits
+            else:
+                hit = self.patterns[name].search(text) is not None
+            if not hit:
+                return False
+        return True
+
+    def _score(self, text: str, first, features: MessageFeatures = None) -> SpamVerdict:
+        hits = []
+        rules = self.rules if features is None else self.text_rules
+        if first:
+            start = first.start()
+            hits = [name for name, pattern in rules if pattern.search(text, start)]
+        if features is not None:
+            hits.extend(self._entity_hits(features))
+        if self._flood_hit(text, features):
+            hits.append(FLOOD_RULE)
+        return SpamVerdict(len(hits) >= self.threshold, len(hits), tuple(hits))
+
+    def is_spam(self, text: str) -> bool:
+        if not text:
+            return False
+        if self.cache is not None:
+            return self.classify(text).is_spam
+        text = text.lower()
+        first = self.trigger.search(text)
+        if not first:
+            return self.threshold <= 1 and self._flood(text)
+        start = first.start()
+        score = 0
+        for _, pattern in self.rules:
+            if pattern.search(text, start):
+                score += 1
+                if score >= self.threshold:
+                    return True
+        # Бонус за ссылки/эмодзи решает только когда до порога не хватает одного балла
+        return score + 1 >= self.threshold and self._flood(text)
+
+    def classify_many(self, texts: Iterable[str]) -> List[SpamVerdict]:
+        return [self.classify(text) for text in texts]
+
+spam_classifier = SpamClassifier(cache=FingerprintCache(FINGERPRINT_CACHE_SIZE) if FINGERPRINT_CACHE_SIZE else None)
+
+# В шардированном режиме: номер своего шарда, общий (через Manager) словарь сводок всех шардов,
+# управляющие очереди шардов (запросы страниц, мимо очереди апдейтов) и очереди ответов на них
+shard_index = None
+shard_views = None
+shard_controls = None
+shard_replies = None
+OVERVIEW_TOP = 5
+CHATS_PAGE_SIZE = 10
+SHARD_PAGE_TIMEOUT = 5
+page_tokens = itertools.count()
+page_lock = asyncio.Lock()
+
+def local_overview() -> dict:
+    index = chat_data.index
+    return {"chats": len(index), "bots": index.total_bots, "deleted": index.total_deleted,
+            "top": index.top(OVERVIEW_TOP)}
+
+async def other_shard_views() -> List[dict]:
+    # Одна копия словаря Manager (только сводки O(K)) и в потоке — event loop не ждёт IPC
+    try:
+        views = await asyncio.to_thread(shard_views.copy)
+    except Exception as e:
+        logger.error(f"Сводки шардов недоступны: {e}")
+        return []
+    return [views[i] for i in range(SHARDS) if i != shard_index and i in views]
+
+async def chat_overview() -> dict:
+    # Сводка для админских экранов: по своему процессу или по всем шардам, O(K) без обхода чатов
+    overview = local_overview()
+    if shard_views is None:
+        return overview
+    parts = [overview] + await other_shard_views()
+    return {
+        "chats": sum(part["chats"] for part in parts),
+        "bots": sum(part["bots"] for part in parts),
+        "deleted": sum(part["deleted"] for part in parts),
+        "top": heapq.nlargest(OVERVIEW_TOP, (item for part in parts for item in part["top"]), key=lambda x: x[1]),
+    }
+
+async def request_shard_rows(cursor, limit: int) -> Tuple[List[list], bool]:
+    # Спрашиваем у остальных шардов их limit строк после cursor: каждый отвечает O(limit),
+    # всех строк шарда никто не копирует. Запрос идёт в управляющую очередь шарда, а не за
+    # его очередью апдейтов; ответы приходят в нашу очередь с номером запроса.
+    # -> (строки по шардам, ответили ли все)
+    loop = asyncio.get_running_loop()
+    others = [i for i in range(SHARDS) if i != shard_index]
+    sources = []
+    async with page_lock:
+        token = next(page_tokens)
+        for i in others:
+            shard_controls[i].put([cursor, limit, shard_index, token])
+        deadline = loop.time() + SHARD_PAGE_TIMEOUT
+        while len(sources) < len(others):
+            try:
+                reply_token, rows = await loop.run_in_executor(
+                    None, functools.partial(shard_replies[shard_index].get, timeout=max(deadline - loop.time(), 0)))
+            except Empty:
+                logger.warning(f"Страница чатов: ответили {len(sources)} из {len(others)} шардов")
+                break
+            if reply_token == token:
+                sources.append([tuple(row) for row in rows])
+    return sources, len(sources) == len(others)
+
+async def serve_page_requests(control):
+    # Строки индекса читаем на event loop шарда, где индекс и меняется; None — остановка
+    loop = asyncio.get_running_loop()
+    while True:
+        request = await loop.run_in_executor(None, control.get)
+        if request is None:
+            return
+        cursor, limit, requester, token = request
+        rows = chat_data.index.rows(cursor, limit)
+        await loop.run_in_executor(None, shard_replies[requester].put, (token, rows))
+
+async def chat_page(cursor=None, size: int = CHATS_PAGE_SIZE):
+    # Страница чатов по возрастанию chat_id строго после cursor; курсор следующей — последний ID страницы.
+    # -> (строки, курсор следующей, полная ли страница). Если какой-то шард не ответил, курсор
+    # не продвигаем: его чаты ниже курсора иначе навсегда выпали бы из листания.
+    sources = [chat_data.index.rows(cursor, size + 1)]
+    complete = True
+    if shard_controls is not None:
+        rows, complete = await request_shard_rows(cursor, size + 1)
+        sources += rows
+    rows = list(islice(heapq.merge(*sources), size + 1))
+    if not complete:
+        return rows[:size], None, False
+    return rows[:size], rows[size - 1][0] if len(rows) > size else None, True
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
@@ -114,50 +1747,50 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     data = query.data
     if data == "admin_stats":
-        total_chats = len(chat_data)
-        total_bots = sum(len(info["bots"]) + len(info["manual_bots"]) for info in chat_data.values())
-        text = f"📊 Статистика:\n🔹 Чатов: {total_chats}\n🔹 Ботов: {total_bots}\n🔹 Обновлено: {datetime.now().strftime('%d.%m.%Y %H:%M')}"
+        overview = await chat_overview()
+        text = f"📊 Статистика:\n🔹 Чатов: {overview['chats']}\n🔹 Ботов: {overview['bots']}\n🔹 Удалено: {overview['deleted']}\n🔹 Обновлено: {datetime.now().strftime('%d.%m.%Y %H:%M')}"
         await query.edit_message_text(text)
-    elif data == "admin_chats":
-        if not chat_data:
+    elif data == "admin_chats" or data.startswith("admin_chats_"):
+        cursor = int(data[len("admin_chats_"):]) if data != "admin_chats" else None
+        rows, next_cursor, complete = await chat_page(cursor)
+        if not rows and complete:
             await query.edit_message_text("📋 Нет чатов.")
             return
-        text = "📋 Чаты:\n"
-        for chat_id, info in list(chat_data.items())[:10]:
-            text += f"🔸 {chat_id}: {len(info['bots']) + len(info['manual_bots'])} ботов\n"
-        if len(chat_data) > 10:
-            text += f"... +{len(chat_data)-10}"
-        await query.edit_message_text(text)
+        text = f"📋 Чаты ({(await chat_overview())['chats']}):\n"
+        for chat_id, count, deleted in rows:
+            text += f"🔸 {chat_id}: {count} ботов, удалено {deleted}\n"
+        buttons = []
+        if not complete:
+            text += "\n⚠️ Часть шардов не ответила — страница неполная, попробуйте ещё раз."
+            buttons.append(InlineKeyboardButton("🔄 Повторить", callback_data=data))
+        if cursor is not None:
+            buttons.append(InlineKeyboardButton("⏮ В начало", callback_data="admin_chats"))
+        if next_cursor is not None:
+            buttons.append(InlineKeyboardButton("➡️ Далее", callback_data=f"admin_chats_{next_cursor}"))
+        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup([buttons]) if buttons else None)
     elif data == "admin_refresh":
-        save_data()
+        await data_saver.flush(force=True)
         await query.edit_message_text("🔄 Обновлено!")
     elif data.startswith("add_bot_"):
         chat_id = int(data.split("_")[-1])
-        member = await context.bot.get_chat_member(chat_id, update.effective_user.id)
-        if member.status not in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]:
+        if not await is_chat_admin(context, chat_id, update.effective_user.id):
             await query.edit_message_text("❌ Только админы чата.")
             return
         await query.edit_message_text("➕ Ответьте на сообщение /addbot или /addbot @username/ID")
     elif data.startswith("remove_bot_"):
         chat_id = int(data.split("_")[-1])
-        member = await context.bot.get_chat_member(chat_id, update.effective_user.id)
-        if member.status not in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]:
+        if not await is_chat_admin(context, chat_id, update.effective_user.id):
             await query.edit_message_text("❌ Только админы чата.")
             return
-        info = chat_data.get(chat_id, {"bots": set(), "manual_bots": set(), "ignored_bots": set()})
-        all_bots = info["bots"].union(info["manual_bots"]) - info["ignored_bots"]
-        if not all_bots:
+        state = chat_data.get(chat_id)
+        if state is None or not state.tracked:
             await query.edit_message_text("❌ Нет ботов.")
             return
         keyboard = []
-        for bot_id in list(all_bots)[:10]:
-            try:
-                bot_info = await context.bot.get_chat(bot_id)
-                name = bot_info.username or bot_info.first_name or str(bot_id)
-                if bot_id < 0:
-                    name = f"Channel: {name}"
-            except:
-                name = str(bot_id)
+        shown = list(state.tracked)[:10]
+        names = await name_resolver.resolve_many(context.bot, shown)
+        for bot_id in shown:
+            name = format_bot_name(bot_id, names.get(bot_id), with_at=False)
             keyboard.append([InlineKeyboardButton(f"❌ {name[:20]}...", callback_data=f"ignore_bot_{chat_id}_{bot_id}")])
         keyboard.append([InlineKeyboardButton("« Назад", callback_data=f"back_to_botlist_{chat_id}")])
         await query.edit_message_text("Выберите для исключения:", reply_markup=InlineKeyboardMarkup(keyboard))
@@ -166,28 +1799,16 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         chat_id = int(parts[2])
         bot_id = int(parts[3])
         if chat_id in chat_data:
-            chat_data[chat_id]["ignored_bots"].add(bot_id)
-            chat_data[chat_id]["bots"].discard(bot_id)
-            chat_data[chat_id]["manual_bots"].discard(bot_id)
-            save_data()
+            chat_data[chat_id].ignore(bot_id)
+            mark_dirty(chat_id)
         await query.edit_message_text(f"✅ Бот {bot_id} исключён.")
     elif data.startswith("back_to_botlist_"):
         chat_id = int(data.split("_")[-1])
-        info = chat_data.get(chat_id, {"bots": set(), "manual_bots": set(), "ignored_bots": set()})
-        all_bots = info["bots"].union(info["manual_bots"]) - info["ignored_bots"]
-        if not all_bots:
+        state = chat_data.get(chat_id)
+        if state is None or not state.tracked:
             text = "🤖 Нет ботов."
         else:
-            text = "🤖 Отслеживаемые боты:\n"
-            for i, bot_id in enumerate(all_bots, 1):
-                try:
-                    bot_info = await context.bot.get_chat(bot_id)
-                    name = f"@{bot_info.username}" if bot_info.username else bot_info.first_name or str(bot_id)
-                    if bot_id < 0:
-                        name = f"Channel: {name}"
-                except:
-                    name = str(bot_id)
-                text += f"{i}. {name} ({bot_id})\n"
+            text = await render_bot_list(context.bot, list(state.tracked))
         keyboard = [
             [InlineKeyboardButton("➕ Добавить", callback_data=f"add_bot_{chat_id}")],
             [InlineKeyboardButton("➖ Исключить", callback_data=f"remove_bot_{chat_id}")]
@@ -199,23 +1820,12 @@ async def botlist_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if chat_id not in chat_data:
         await update.message.reply_text("🤖 Нет ботов.")
         return
-    info = chat_data[chat_id]
-    all_bots = info["bots"].union(info["manual_bots"]) - info["ignored_bots"]
-    if not all_bots:
+    state = chat_data[chat_id]
+    if not state.tracked:
         await update.message.reply_text("🤖 Нет ботов.")
         return
-    text = "🤖 Отслеживаемые боты:\n"
-    for i, bot_id in enumerate(all_bots, 1):
-        try:
-            bot_info = await context.bot.get_chat(bot_id)
-            name = f"@{bot_info.username}" if bot_info.username else bot_info.first_name or str(bot_id)
-            if bot_id < 0:
-                name = f"Channel: {name}"
-        except:
-            name = str(bot_id)
-        text += f"{i}. {name} ({bot_id})\n"
-    member = await context.bot.get_chat_member(chat_id, update.effective_user.id)
-    if member.status in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]:
+    text = await render_bot_list(context.bot, list(state.tracked))
+    if await is_chat_admin(context, chat_id, update.effective_user.id):
         keyboard = [
             [InlineKeyboardButton("➕ Добавить", callback_data=f"add_bot_{chat_id}")],
             [InlineKeyboardButton("➖ Исключить", callback_data=f"remove_bot_{chat_id}")]
@@ -226,12 +1836,12 @@ async def botlist_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def addbot_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    member = await context.bot.get_chat_member(chat_id, update.effective_user.id)
-    if member.status not in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]:
+    if not await is_chat_admin(context, chat_id, update.effective_user.id):
         await update.message.reply_text("❌ Только админы.")
         return
     if chat_id not in chat_data:
-        chat_data[chat_id] = {"bots": set(), "manual_bots": set(), "ignored_bots": set()}
+        chat_data[chat_id] = ChatState()
+        mark_dirty(chat_id)
     added = []
     errors = []
     if update.message.reply_to_message:
@@ -251,8 +1861,7 @@ async def addbot_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             name = reply_msg.forward_sender_name
             errors.append(f"❌ {name}: Скрытый отправитель, используй ID.")
         if target_id:
-            chat_data[chat_id]["manual_bots"].add(target_id)
-            chat_data[chat_id]["ignored_bots"].discard(target_id)
+            chat_data[chat_id].add_manual(target_id)
             added.append(name)
         else:
             logger.info(f"addbot: target_id None for reply in {chat_id}")
@@ -264,6 +1873,7 @@ async def addbot_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if arg.startswith('@'):
                 try:
                     chat = await context.bot.get_chat(arg)
+                    name_resolver.remember(chat)
                     target_id = chat.id
                     name = f"@{chat.username}" if chat.username else chat.first_name or str(target_id)
                     if target_id < 0:
@@ -275,14 +1885,13 @@ async def addbot_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             else:
                 errors.append(f"❌ {arg}: Неверный формат (ID или @username).")
             if target_id:
-                chat_data[chat_id]["manual_bots"].add(target_id)
-                chat_data[chat_id]["ignored_bots"].discard(target_id)
+                chat_data[chat_id].add_manual(target_id)
                 added.append(name)
     else:
         await update.message.reply_text("Использование:\n• Reply: /addbot\n• /addbot @username/ID [другие...]")
         return
     if added or errors:
-        save_data()
+        mark_dirty(chat_id)
         text = ""
         if added:
             text += "✅ Добавлены: " + ", ".join(added) + "\n"
@@ -292,8 +1901,7 @@ async def addbot_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def removebot_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    member = await context.bot.get_chat_member(chat_id, update.effective_user.id)
-    if member.status not in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]:
+    if not await is_chat_admin(context, chat_id, update.effective_user.id):
         await update.message.reply_text("❌ Только админы.")
         return
     if chat_id not in chat_data:
@@ -318,12 +1926,10 @@ async def removebot_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             name = reply_msg.forward_sender_name
             errors.append(f"❌ {name}: Скрытый, используй ID.")
         if target_id:
-            if target_id not in chat_data[chat_id]["bots"] and target_id not in chat_data[chat_id]["manual_bots"]:
+            if not chat_data[chat_id].is_listed(target_id):
                 errors.append(f"❌ {name}: Не в списке.")
             else:
-                chat_data[chat_id]["ignored_bots"].add(target_id)
-                chat_data[chat_id]["bots"].discard(target_id)
-                chat_data[chat_id]["manual_bots"].discard(target_id)
+                chat_data[chat_id].ignore(target_id)
                 removed.append(name)
         else:
             logger.info(f"removebot: target_id None for reply in {chat_id}")
@@ -335,6 +1941,7 @@ async def removebot_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if arg.startswith('@'):
                 try:
                     chat = await context.bot.get_chat(arg)
+                    name_resolver.remember(chat)
                     target_id = chat.id
                     name = f"@{chat.username}" if chat.username else chat.first_name or str(target_id)
                     if target_id < 0:
@@ -346,18 +1953,16 @@ async def removebot_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             else:
                 errors.append(f"❌ {arg}: Неверный формат.")
             if target_id:
-                if target_id not in chat_data[chat_id]["bots"] and target_id not in chat_data[chat_id]["manual_bots"]:
+                if not chat_data[chat_id].is_listed(target_id):
                     errors.append(f"❌ {name}: Не в списке.")
                 else:
-                    chat_data[chat_id]["ignored_bots"].add(target_id)
-                    chat_data[chat_id]["bots"].discard(target_id)
-                    chat_data[chat_id]["manual_bots"].discard(target_id)
+                    chat_data[chat_id].ignore(target_id)
                     removed.append(name)
     else:
         await update.message.reply_text("Использование:\n• Reply: /removebot\n• /removebot @username/ID [другие...]")
         return
     if removed or errors:
-        save_data()
+        mark_dirty(chat_id)
         text = ""
         if removed:
             text += "✅ Исключены: " + ", ".join(removed) + "\n"
@@ -367,23 +1972,21 @@ async def removebot_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def refreshbot_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    member = await context.bot.get_chat_member(chat_id, update.effective_user.id)
-    if member.status not in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]:
+    if not await is_chat_admin(context, chat_id, update.effective_user.id):
         await update.message.reply_text("❌ Только админы.")
         return
     if chat_id not in chat_data:
         await update.message.reply_text("❌ Нет данных.")
         return
-    chat_data[chat_id]["bots"] = set()
+    chat_data[chat_id].set_bots(())
     try:
-        admins = await context.bot.get_chat_administrators(chat_id)
-        for admin in admins:
-            user = admin.user
-            if (user.is_bot or is_bot_by_username(user.username)) and user.id != context.bot.id:
-                chat_data[chat_id]["bots"].add(user.id)
+        # /refreshbot — явная просьба перечитать админов: кэш состава не используем
+        admin_rosters.invalidate(chat_id)
+        roster = await admin_rosters.get(context.bot, chat_id)
+        chat_data[chat_id].set_bots(bots_in_roster(roster, context.bot.id))
     except Exception as e:
         logger.warning(f"Скан админов ошибка: {e}")
-    save_data()
+    mark_dirty(chat_id)
     await update.message.reply_text("✅ Список обновлён. Боты среди админов добавлены. Новые — при сообщениях.")
 
 async def handle_new_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -392,18 +1995,17 @@ async def handle_new_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
     for member in message.new_chat_members:
         if member.id == context.bot.id:
             if chat_id not in chat_data:
-                chat_data[chat_id] = {"bots": set(), "manual_bots": set(), "ignored_bots": set()}
-                save_data()
+                chat_data[chat_id] = ChatState()
+                mark_dirty(chat_id)
             await message.reply_text(
                 "🤖 Привет! Я модерирую рекламу от ботов.\n\n⚠️ Дайте админ-права на удаление.\n\nКоманды:\n/botlist\n/addbot\n/removebot\n/refreshbot\n\nОбнаруживаю по username ends with 'bot'."
             )
             try:
-                admins = await context.bot.get_chat_administrators(chat_id)
-                for admin in admins:
-                    user = admin.user
-                    if (user.is_bot or is_bot_by_username(user.username)) and user.id != context.bot.id:
-                        chat_data[chat_id]["bots"].add(user.id)
-                save_data()
+                admin_rosters.invalidate(chat_id)
+                roster = await admin_rosters.get(context.bot, chat_id)
+                for bot_id in bots_in_roster(roster, context.bot.id):
+                    chat_data[chat_id].add_bot(bot_id)
+                mark_dirty(chat_id)
             except:
                 pass
             break
@@ -418,8 +2020,11 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     target_id = from_user.id if from_user else sender_chat.id if sender_chat else None
     if target_id == context.bot.id or target_id is None:
         return
-    if chat_id not in chat_data:
-        chat_data[chat_id] = {"bots": set(), "manual_bots": set(), "ignored_bots": set()}
+    metrics.inc("messages_seen_total")
+    state = await chat_data.load(chat_id)
+    if state is None:
+        state = chat_data[chat_id] = ChatState()
+        mark_dirty(chat_id)
     is_bot = False
     username = ""
     if from_user:
@@ -428,44 +2033,193 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif sender_chat:
         is_bot = is_bot_by_username(sender_chat.username)
         username = sender_chat.username
-    if is_bot:
-        chat_data[chat_id]["bots"].add(target_id)
-        save_data()
-    if target_id in chat_data[chat_id]["ignored_bots"]:
-        return
-    all_tracked = chat_data[chat_id]["bots"].union(chat_data[chat_id]["manual_bots"])
-    if target_id not in all_tracked:
+    if is_bot and state.add_bot(target_id):
+        mark_dirty(chat_id)
+    if target_id not in state.tracked:
         return
+    metrics.inc("tracked_sender_messages_total")
+    name_resolver.remember(from_user or sender_chat)
     text = message.text or message.caption or ""
-    if await is_spam_message(text):
+    with timed("spam_classify_seconds"):
+        features = extract_features(text, message.entities if message.text else message.caption_entities)
+        verdict = spam_classifier.classify(text, features)
+    if features.hidden_links:
+        metrics.inc("hidden_links_total", features.hidden_links)
+    if verdict.is_spam:
+        metrics.inc("spam_verdicts_total")
+        for rule in verdict.rules:
+            metrics.inc("spam_rule_hits_total", rule=rule)
         try:
-            bot_member = await context.bot.get_chat_member(chat_id, context.bot.id)
-            if bot_member.status == ChatMemberStatus.ADMINISTRATOR and bot_member.can_delete_messages:
-                await message.delete()
+            if await bot_permissions.can_delete(context.bot, chat_id):
+                await api_scheduler.call(PRIORITY_DELETE, chat_id, message.delete, retries=API_MAX_RETRIES)
+                metrics.inc("deletions_total")
+                state.record_deletion()
+                mark_dirty(chat_id)
+                # От отправки сообщения (часы Telegram, точность — секунда) до удаления
+                metrics.observe("update_to_delete_seconds", time.time() - message.date.timestamp(), mode=INGRESS_MODE)
                 logger.info(f"Удалено от {username} ({target_id}) в {chat_id}")
-                notification = await context.bot.send_message(chat_id, f"🚫 Удалена реклама от @{username}")
-                await asyncio.sleep(5)
-                await notification.delete()
+                context.application.create_task(send_deletion_notice(context.bot, chat_id, username))
             else:
                 logger.warning(f"Нет прав в {chat_id}")
+        except RetryAfter as e:
+            logger.error(f"Флуд-контроль: не удалось удалить {message.message_id} в {chat_id} "
+                         f"после {API_MAX_RETRIES} повторов (retry_after={e.retry_after})")
         except Exception as e:
+            # Возможно, права отобрали без my_chat_member — в следующий раз спросим заново
+            bot_permissions.invalidate(chat_id)
             logger.error(f"Ошибка: {e}")
 
+async def handle_my_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    member_update = update.my_chat_member
+    can_delete = bot_permissions.set_from_member(member_update.chat.id, member_update.new_chat_member)
+    admin_rosters.apply_member(member_update.chat.id, member_update.new_chat_member)
+    logger.info(f"Права в {member_update.chat.id}: {member_update.new_chat_member.status}, удаление: {can_delete}")
+
+async def handle_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    member_update = update.chat_member
+    admin_rosters.apply_member(member_update.chat.id, member_update.new_chat_member)
+
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID:
         await update.message.reply_text("❌ Нет прав.")
         return
-    total_chats = len(chat_data)
-    total_bots = sum(len(info["bots"]) + len(info["manual_bots"]) for info in chat_data.values())
-    text = f"📊 Статистика:\n🔹 Чатов: {total_chats}\n🔹 Ботов: {total_bots}\n🔹 Время: {datetime.now().strftime('%d.%m.%Y %H:%M')}\n\nТоп-5 чатов:\n"
-    sorted_chats = sorted(chat_data.items(), key=lambda x: len(x[1]["bots"]) + len(x[1]["manual_bots"]), reverse=True)[:5]
-    for i, (cid, info) in enumerate(sorted_chats, 1):
-        text += f"{i}. {cid}: {len(info['bots']) + len(info['manual_bots'])} ботов\n"
+    overview = await chat_overview()
+    text = f"📊 Статистика:\n🔹 Чатов: {overview['chats']}\n🔹 Ботов: {overview['bots']}\n🔹 Удалено: {overview['deleted']}\n🔹 Время: {datetime.now().strftime('%d.%m.%Y %H:%M')}\n\nТоп-5 чатов:\n"
+    for i, (cid, count) in enumerate(overview["top"], 1):
+        text += f"{i}. {cid}: {count} ботов\n"
+    if shard_index is not None:
+        # Ниже — счётчики процесса, который обработал команду
+        text += f"\nШард {shard_index + 1} из {SHARDS}"
+    text += f"\nКэш прав: попаданий {bot_permissions.hits}, промахов {bot_permissions.misses}"
+    text += f"\nКэш админов: попаданий {admin_rosters.hits}, промахов {admin_rosters.misses}"
+    api = api_scheduler.stats()
+    text += (f"\nAPI: очередь {api['queue']}, отправлено {api['sent']}, ожиданий лимита {api['throttled']}, "
+             f"429 {api['flood_waits']}, повторов {api['retries']}, ошибок {api['failed']}")
+    if spam_classifier.cache is not None:
+        fp = spam_classifier.cache.stats()
+        text += (f"\nОтпечатки спама: точных {fp['exact_hits']}, похожих {fp['near_hits']} "
+                 f"(отклонено {fp['near_rejected']}), промахов {fp['misses']}, hit rate {fp['hit_rate']:.0%}")
+    scan = roster_rescanner.last
+    if scan:
+        text += (f"\nСверка админов {datetime.fromtimestamp(scan['finished']).strftime('%d.%m %H:%M')}: "
+                 f"{scan['chats']} чатов за {scan['seconds']:.1f} с, изменено {scan['changed']}, "
+                 f"без прав {scan['lost_rights']}, недоступно {scan['removed']}")
     await update.message.reply_text(text)
 
-def main():
-    load_data()
-    application = Application.builder().token(BOT_TOKEN).build()
+def update_chat_id(update):
+    if isinstance(update, Update) and update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    # Апдейты разных чатов обрабатываются параллельно, апдейты одного чата — строго по очереди.
+    # Семафор базового класса берётся ещё до ожидания очереди чата, поэтому один
+    # «шумный» чат занял бы им все слоты. Лимит обработчиков держим своим семафором,
+    # который берётся уже после блокировки чата, а базовому отдаём лимит ожидающих.
+    # max_concurrent_updates базового класса — это лимит ожидающих (по нему строится его
+    # семафор), число одновременно работающих обработчиков — worker_limit.
+    def __init__(self, max_concurrent_updates: int, max_pending_updates: int = 10000):
+        super().__init__(max(max_pending_updates, max_concurrent_updates))
+        self.worker_limit = max_concurrent_updates
+        self._workers = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._chat_locks: Dict[int, asyncio.Lock] = {}
+        self._chat_waiters: Dict[int, int] = {}
+
+    async def do_process_update(self, update, coroutine):
+        chat_id = update_chat_id(update)
+        if chat_id is None:
+            async with self._workers:
+                await coroutine
+            return
+        lock = self._chat_locks.get(chat_id)
+        if lock is None:
+            lock = self._chat_locks[chat_id] = asyncio.Lock()
+        self._chat_waiters[chat_id] = self._chat_waiters.get(chat_id, 0) + 1
+        try:
+            async with lock:
+                async with self._workers:
+                    await coroutine
+        finally:
+            self._chat_waiters[chat_id] -= 1
+            if not self._chat_waiters[chat_id]:
+                del self._chat_waiters[chat_id]
+                del self._chat_locks[chat_id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+def instrument_handler(callback):
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception as e:
+            metrics.inc("handler_errors_total", handler=name, type=type(e).__name__)
+            raise
+        finally:
+            metrics.observe("handler_seconds", time.perf_counter() - started, handler=name)
+
+    return wrapper
+
+def instrument_handlers(application: Application):
+    # Оборачиваем уже зарегистрированные обработчики, сами функции не трогаем
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = instrument_handler(handler.callback)
+
+def register_metrics():
+    metrics.gauge("chats", lambda: len(chat_data))
+    metrics.gauge("dirty_chats", lambda: len(data_saver.dirty))
+    metrics.gauge("api_queue_depth", api_scheduler.depth)
+    metrics.gauge("pending_notice_deletions", deletion_scheduler.pending)
+    metrics.counter("permission_cache_hits_total", lambda: bot_permissions.hits)
+    metrics.counter("permission_cache_misses_total", lambda: bot_permissions.misses)
+    metrics.counter("admin_roster_hits_total", lambda: admin_rosters.hits)
+    metrics.counter("admin_roster_misses_total", lambda: admin_rosters.misses)
+    if spam_classifier.cache is not None:
+        cache = spam_classifier.cache
+        metrics.counter("fingerprint_exact_hits_total", lambda: cache.exact_hits)
+        metrics.counter("fingerprint_near_hits_total", lambda: cache.near_hits)
+        metrics.counter("fingerprint_near_rejected_total", lambda: cache.near_rejected)
+        metrics.counter("fingerprint_misses_total", lambda: cache.misses)
+    metrics.gauge("rescan_last_changed_chats", lambda: roster_rescanner.last.get("changed", 0))
+    metrics.gauge("rescan_last_lost_rights", lambda: roster_rescanner.last.get("lost_rights", 0))
+    metrics.gauge("rescan_last_removed", lambda: roster_rescanner.last.get("removed", 0))
+
+async def on_startup(application: Application):
+    register_metrics()
+    if METRICS_PORT:
+        application.bot_data["metrics_server"] = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+    data_saver.start()
+    api_scheduler.start()
+    deletion_scheduler.load()
+    deletion_scheduler.start(application.bot)
+    roster_rescanner.start(application.bot)
+
+async def on_shutdown(application: Application):
+    await roster_rescanner.stop()
+    await deletion_scheduler.stop()
+    await api_scheduler.stop()
+    await data_saver.stop()
+    server = application.bot_data.pop("metrics_server", None)
+    if server is not None:
+        server.close()
+        await server.wait_closed()
+
+def build_application(bot=None, updater: bool = True) -> Application:
+    builder = Application.builder().post_init(on_startup).post_shutdown(on_shutdown)
+    builder = builder.bot(bot) if bot is not None else builder.token(BOT_TOKEN)
+    if not updater:
+        builder = builder.updater(None)
+    if CONCURRENT_UPDATES > 1:
+        builder = builder.concurrent_updates(ChatOrderedUpdateProcessor(CONCURRENT_UPDATES))
+    application = builder.build()
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("admin", admin_panel))
     application.add_handler(CommandHandler("stats", stats_command))
@@ -474,10 +2228,318 @@ def main():
     application.add_handler(CommandHandler("removebot", removebot_command))
     application.add_handler(CommandHandler("refreshbot", refreshbot_command))
     application.add_handler(CallbackQueryHandler(button_callback))
+    application.add_handler(ChatMemberHandler(handle_my_chat_member, ChatMemberHandler.MY_CHAT_MEMBER))
+    application.add_handler(ChatMemberHandler(handle_chat_member, ChatMemberHandler.CHAT_MEMBER))
     application.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, handle_new_member))
     application.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, handle_message))
+    instrument_handlers(application)
+    return application
+
+def allowed_update_types(application: Application) -> List[str]:
+    # Подписываемся только на то, что читают зарегистрированные обработчики. Команды и
+    # сообщения берутся из update.message, поэтому правки и посты каналов не запрашиваем.
+    types = set()
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if isinstance(handler, ChatMemberHandler):
+                if handler.chat_member_types in (ChatMemberHandler.MY_CHAT_MEMBER, ChatMemberHandler.ANY_CHAT_MEMBER):
+                    types.add(Update.MY_CHAT_MEMBER)
+                if handler.chat_member_types in (ChatMemberHandler.CHAT_MEMBER, ChatMemberHandler.ANY_CHAT_MEMBER):
+                    types.add(Update.CHAT_MEMBER)
+            elif isinstance(handler, CallbackQueryHandler):
+                types.add(Update.CALLBACK_QUERY)
+            elif isinstance(handler, (CommandHandler, MessageHandler)):
+                types.add(Update.MESSAGE)
+            else:
+                return list(Update.ALL_TYPES)
+    return sorted(types)
+
+def application_sink(application: Application):
+    # Апдейт из webhook идёт прямо в процессор приложения; sink завершается, когда он обработан
+    async def sink(data):
+        update = Update.de_json(data, application.bot)
+        await application.update_processor.process_update(update, application.process_update(update))
+    return sink
+
+def cancel_on_sigterm():
+    task = asyncio.current_task()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+
+async def run_webhook_intake(bot, intake: WebhookIntake, allowed_updates: List[str]):
+    server = await intake.start(WEBHOOK_HOST, WEBHOOK_PORT)
+    metrics.gauge("webhook_pending", lambda: intake.pending)
+    await bot.set_webhook(WEBHOOK_URL, allowed_updates=allowed_updates, secret_token=intake.secret,
+                          max_connections=WEBHOOK_MAX_CONNECTIONS)
+    logger.info(f"Webhook: {WEBHOOK_URL} -> {WEBHOOK_HOST}:{WEBHOOK_PORT}{intake.path}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        server.close()
+        await server.wait_closed()
+        await intake.drain()
+
+async def serve_webhook(application: Application):
+    cancel_on_sigterm()
+    await application.initialize()
+    await on_startup(application)
+    await application.start()
+    intake = WebhookIntake(application_sink(application), WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_QUEUE_SIZE)
+    try:
+        await run_webhook_intake(application.bot, intake, allowed_update_types(application))
+    finally:
+        await application.stop()
+        await on_shutdown(application)
+        await application.shutdown()
+
+def shard_path(path: str, index: int) -> str:
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{index}{ext}"
+
+def chat_shard(chat_id, shards: int = None) -> int:
+    # Апдейты без чата (inline и т.п.) идут в нулевой шард
+    return chat_id % (shards or SHARDS) if chat_id is not None else 0
+
+def make_shard_storage(backend: str, index: int):
+    if backend == 'sqlite':
+        return SqliteStorage(shard_path(DB_FILE, index))
+    return JsonStorage(shard_path(DATA_FILE, index))
+
+def data_shard_files(shards: int) -> List[str]:
+    return [shard_path(DB_FILE if STORAGE_BACKEND == 'sqlite' else DATA_FILE, i) for i in range(shards)]
+
+def stored_shard_count():
+    # Число шардов, по которому разложены данные; для раскладок без SHARDS_FILE — по файлам шардов
+    if os.path.exists(SHARDS_FILE):
+        with open(SHARDS_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)["shards"]
+    count = 0
+    while os.path.exists(data_shard_files(count + 1)[count]):
+        count += 1
+    return count or None
+
+def check_shard_count(shards: int):
+    # Чат живёт в файле шарда chat_id % SHARDS: при другом SHARDS его апдейты уходили бы
+    # в шард, у которого нет его данных. Перераскладка не поддерживается — отказываемся стартовать.
+    stored = stored_shard_count()
+    if stored is not None and stored != shards:
+        logger.error(f"Данные разложены по {stored} шардам, а SHARDS={shards}. "
+                     f"Верните SHARDS={stored} или перенесите данные вручную")
+        raise SystemExit(1)
+    if shards > 1 and not os.path.exists(SHARDS_FILE):
+        write_json_atomic(SHARDS_FILE, {"shards": shards})
+
+def split_data_into_shards(shards: int):
+    # Первый запуск с SHARDS: общий файл данных раскладывается по файлам шардов
+    if any(os.path.exists(path) for path in data_shard_files(shards)):
+        return
+    if not os.path.exists(DATA_FILE) and not os.path.exists(DB_FILE):
+        return
+    source = make_storage(STORAGE_BACKEND)
+    try:
+        ids, chats = source.load_index()
+        parts = [ChatRegistry() for _ in range(shards)]
+        for chat_id in ids:
+            state = chats.get(chat_id) or source.load_chat(chat_id) or ChatState()
+            parts[chat_shard(chat_id, shards)][chat_id] = state
+        for index, part in enumerate(parts):
+            target = make_shard_storage(STORAGE_BACKEND, index)
+            try:
+                target.write(target.snapshot(part, set(part)))
+            finally:
+                target.close()
+            logger.info(f"Шард {index}: перенесено чатов {len(part)}")
+    finally:
+        source.close()
+
+def ignore_stop_signals():
+    # Ctrl+C получает вся группа процессов, а systemd (KillMode=control-group) шлёт SIGTERM
+    # каждому процессу группы. Шарды останавливает входной процесс, чтобы они успели сохраниться.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+def publish_shard_view():
+    # Только сводка O(K); строки для страниц шард отдаёт по запросу (serve_page_requests)
+    shard_views[shard_index] = local_overview()
+
+async def publish_overview(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            # Сводку считаем на loop, а запись в Manager (IPC) уводим в поток
+            await asyncio.to_thread(shard_views.__setitem__, shard_index, local_overview())
+        except Exception as e:
+            logger.error(f"Не удалось опубликовать сводку шарда {shard_index}: {e}")
+
+async def serve_shard(index: int, queue, controls, replies, views):
+    global DATA_FILE, DB_FILE, METRICS_PORT, shard_index, shard_views, shard_controls, shard_replies
+    shard_index, shard_views, shard_controls, shard_replies = index, views, controls, replies
+    # Каждый шард отдаёт свои метрики на своём порту: METRICS_PORT + номер шарда
+    if METRICS_PORT:
+        METRICS_PORT += index
+    DATA_FILE, DB_FILE = shard_path(DATA_FILE, index), shard_path(DB_FILE, index)
+    deletion_scheduler.path = shard_path(DELETIONS_FILE, index)
+    # Глобальный лимит Telegram общий для токена — делим его между шардами
+    rate = API_GLOBAL_RATE / SHARDS
+    api_scheduler.global_bucket = TokenBucket(rate, rate)
+    load_data()
+    application = build_application(updater=False)
+    loop = asyncio.get_running_loop()
+    await application.initialize()
+    await on_startup(application)
+    await application.start()
+    publish_shard_view()
+    reporter = asyncio.create_task(publish_overview(SAVE_INTERVAL))
+    pages = asyncio.create_task(serve_page_requests(controls[index]))
+    logger.info(f"Шард {index} запущен, чатов: {len(chat_data)}")
+    try:
+        while True:
+            data = await loop.run_in_executor(None, queue.get)
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+        await application.update_queue.join()
+    finally:
+        reporter.cancel()
+        # Поток, ждущий управляющую очередь, отпускаем явно — иначе asyncio.run ждал бы его вечно
+        controls[index].put(None)
+        await pages
+        await application.stop()
+        await on_shutdown(application)
+        await application.shutdown()
+
+def run_shard(index: int, queue, controls, replies, views):
+    ignore_stop_signals()
+    asyncio.run(serve_shard(index, queue, controls, replies, views))
+
+def raw_update_chat_id(data: dict):
+    # chat_id прямо из JSON апдейта, без сборки объекта Update
+    for key, payload in data.items():
+        if key != 'update_id' and isinstance(payload, dict):
+            chat = payload.get('chat') or (payload.get('message') or {}).get('chat')
+            return chat['id'] if chat else None
+    return None
+
+async def poll_into_shards(bot, queues, allowed_updates: List[str]):
+    # Входной процесс не разбирает апдейты: сырые словари getUpdates сразу уходят в очередь шарда.
+    # Один чат всегда попадает в один шард, очередь FIFO — порядок внутри чата сохраняется.
+    offset = 0
+    try:
+        while True:
+            try:
+                updates = await bot._post('getUpdates', {
+                    'offset': offset, 'timeout': SHARD_POLL_TIMEOUT, 'allowed_updates': allowed_updates,
+                }, read_timeout=SHARD_POLL_TIMEOUT + 10)
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+                continue
+            except TelegramError as e:
+                logger.error(f"Ошибка getUpdates: {e}")
+                await asyncio.sleep(1)
+                continue
+            for data in updates:
+                offset = data['update_id'] + 1
+                queues[chat_shard(raw_update_chat_id(data), len(queues))].put(data)
+    finally:
+        if offset:
+            # Подтверждаем уже разосланные апдейты, чтобы после перезапуска они не пришли снова
+            try:
+                await bot._post('getUpdates', {'offset': offset, 'timeout': 0})
+            except TelegramError as e:
+                logger.error(f"Не удалось подтвердить апдейты: {e}")
+
+def shard_sink(queues):
+    async def sink(data):
+        queues[chat_shard(raw_update_chat_id(data), len(queues))].put(data)
+    return sink
+
+def shard_backlog(queues) -> int:
+    try:
+        return max(queue.qsize() for queue in queues)
+    except NotImplementedError:
+        # macOS не умеет qsize у multiprocessing.Queue — остаётся только лимит самого приёма
+        return 0
+
+async def watch_shards(workers):
+    # Апдейты умершего шарда копились бы в его очереди без ограничений (а webhook отвечал бы 503)
+    while True:
+        await asyncio.sleep(SHARD_WATCH_INTERVAL)
+        for worker in workers:
+            if not worker.is_alive():
+                raise RuntimeError(f"{worker.name} завершился с кодом {worker.exitcode}")
+
+async def receive_updates(bot, queues, allowed_updates: List[str]):
+    if WEBHOOK_URL:
+        intake = WebhookIntake(shard_sink(queues), WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_QUEUE_SIZE,
+                               backlog=lambda: shard_backlog(queues))
+        await run_webhook_intake(bot, intake, allowed_updates)
+    else:
+        await bot.delete_webhook()
+        await poll_into_shards(bot, queues, allowed_updates)
+
+async def run_ingress(queues, workers):
+    cancel_on_sigterm()
+    allowed_updates = allowed_update_types(build_application(updater=False))
+    async with Bot(BOT_TOKEN) as bot:
+        tasks = [asyncio.create_task(receive_updates(bot, queues, allowed_updates)),
+                 asyncio.create_task(watch_shards(workers))]
+        try:
+            # Если умер шард, останавливаемся целиком: остальные шарды сохраняются,
+            # процесс выходит с ошибкой, и супервизор (systemd Restart=) поднимает всё заново
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            for queue in queues:
+                queue.put(None)
+            for worker in workers:
+                await asyncio.to_thread(worker.join, 60)
+                if worker.is_alive():
+                    logger.error(f"{worker.name} не остановился, завершаем принудительно")
+                    worker.kill()
+
+def run_sharded():
+    check_shard_count(SHARDS)
+    split_data_into_shards(SHARDS)
+    ctx = multiprocessing.get_context('spawn')
+    manager = SyncManager(ctx=ctx)
+    manager.start(ignore_stop_signals)
+    views = manager.dict()
+    queues = [ctx.Queue() for _ in range(SHARDS)]
+    controls = [ctx.Queue() for _ in range(SHARDS)]
+    replies = [manager.Queue() for _ in range(SHARDS)]
+    workers = [ctx.Process(target=run_shard, args=(i, queues[i], controls, replies, views), name=f"shard-{i}")
+               for i in range(SHARDS)]
+    for worker in workers:
+        worker.start()
+    print(f"🤖 Бот запущен! Шардов: {SHARDS}")
+    try:
+        asyncio.run(run_ingress(queues, workers))
+    except KeyboardInterrupt:
+        pass
+    except RuntimeError as e:
+        logger.error(f"Остановка: {e}")
+        raise SystemExit(1)
+    finally:
+        manager.shutdown()
+
+def main():
+    if SHARDS > 1:
+        run_sharded()
+        return
+    check_shard_count(SHARDS)
+    load_data()
+    application = build_application(updater=not WEBHOOK_URL)
     print("🤖 Бот запущен! (Бесплатно 24/7)")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if WEBHOOK_URL:
+        try:
+            asyncio.run(serve_webhook(application))
+        except KeyboardInterrupt:
+            pass
+        return
+    application.run_polling(allowed_updates=allowed_update_types(application))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,272 @@
+import argparse
+import json
+import os
+import re
+import time
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+
+from telegram import MessageEntity
+
+import bot
+
+# Офлайн-прогон классификатора спама по выгрузке чата: тот же SpamClassifier и те же
+# признаки из сущностей, что в handle_message, только без кэша отпечатков.
+#
+#   python classify_corpus.py result.json                        # выгрузка Telegram Desktop
+#   python classify_corpus.py updates.jsonl --labels labels.jsonl
+#   python classify_corpus.py result.json --dump-rules rules_v1.json   # снимок текущих правил
+#   python classify_corpus.py result.json --rules rules_v1.json        # сравнение с ним
+
+MESSAGES_START_RE = re.compile(r'"messages"\s*:\s*\[')
+CHUNK_SIZE = 1 << 20
+BATCH_SIZE = 500
+# Типы text_entities выгрузки -> типы сущностей Bot API, которые читает extract_features
+EXPORT_ENTITY_TYPES = {
+    "link": MessageEntity.URL,
+    "text_link": MessageEntity.TEXT_LINK,
+    "mention": MessageEntity.MENTION,
+    "custom_emoji": MessageEntity.CUSTOM_EMOJI,
+}
+
+def iter_export_messages(path: str, chunk_size: int = CHUNK_SIZE):
+    # Выгрузка — один большой объект; читаем её кусками и достаём элементы массива
+    # "messages" по одному через raw_decode, не держа файл в памяти целиком
+    decoder = json.JSONDecoder()
+    with open(path, encoding="utf-8") as f:
+        buffer = ""
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                return
+            buffer += chunk
+            match = MESSAGES_START_RE.search(buffer)
+            if match:
+                buffer = buffer[match.end():]
+                break
+            buffer = buffer[-32:]
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+                pos += 1
+            if pos < len(buffer) and buffer[pos] == "]":
+                return
+            try:
+                message, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    raise
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                continue
+            yield message
+            if pos > chunk_size:
+                buffer = buffer[pos:]
+                pos = 0
+
+def iter_jsonl(path: str):
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def utf16_len(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+def from_export(message):
+    # text в выгрузке — строка или список кусков; смещения сущностей считаем в UTF-16, как у Bot API
+    parts = message.get("text_entities")
+    if parts is None:
+        raw = message.get("text", "")
+        parts = [{"type": "plain", "text": part} if isinstance(part, str) else part
+                 for part in (raw if isinstance(raw, list) else [raw])]
+    text, entities, offset = "", [], 0
+    for part in parts:
+        chunk = part.get("text", "")
+        kind = EXPORT_ENTITY_TYPES.get(part.get("type"))
+        if kind is not None:
+            entities.append((kind, offset, utf16_len(chunk), part.get("href")))
+        text += chunk
+        offset += utf16_len(chunk)
+    return text, entities
+
+def normalize(record, index: int):
+    # -> (ключ, текст, сущности или None, метка или None); поддерживаются сообщения выгрузки,
+    # апдейты/сообщения Bot API и простые строки {"id", "text", "spam"}. Без данных о сущностях
+    # (None) классификатор ищет ссылки и упоминания регэкспом по тексту, как SpamClassifier.classify(text)
+    if "update_id" in record:
+        record = record.get("message") or {}
+    if record.get("type", "message") != "message":
+        return None
+    key = record.get("id", record.get("message_id", index))
+    label = record.get("spam")
+    if "text_entities" in record or isinstance(record.get("text"), list):
+        text, entities = from_export(record)
+    else:
+        text = record.get("text") or record.get("caption") or ""
+        raw = record.get("entities") if record.get("text") else record.get("caption_entities")
+        entities = None if raw is None else [
+            (entity["type"], entity["offset"], entity["length"], entity.get("url")) for entity in raw]
+    if not text:
+        return None
+    return key, text, entities, label
+
+def load_rules(path: str):
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    if isinstance(data, list):
+        data = {"rules": data}
+    return [tuple(rule) for rule in data["rules"]], data.get("threshold", bot.SPAM_THRESHOLD)
+
+def dump_rules(path: str):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"threshold": bot.SPAM_THRESHOLD, "rules": [list(rule) for rule in bot.SPAM_RULES]},
+                  f, ensure_ascii=False, indent=2)
+
+_classifiers = None
+
+def init_worker(baseline):
+    global _classifiers
+    _classifiers = [bot.SpamClassifier()]
+    if baseline is not None:
+        rules, threshold = baseline
+        _classifiers.append(bot.SpamClassifier(rules, threshold))
+
+def classify_batch(batch):
+    results = []
+    for key, text, entities, label in batch:
+        features = None if entities is None else bot.extract_features(
+            text, [MessageEntity(kind, offset, length, url=url) for kind, offset, length, url in entities])
+        verdicts = [classifier.classify(text, features) for classifier in _classifiers]
+        results.append((key, text, label, verdicts))
+    return results
+
+def batches(records, size: int):
+    batch = []
+    for index, record in enumerate(records):
+        item = normalize(record, index)
+        if item is None:
+            continue
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def run_pool(batch_iter, workers: int, baseline):
+    # Не больше 2 * workers пачек в работе: файл читается по мере классификации
+    with ProcessPoolExecutor(workers, initializer=init_worker, initargs=(baseline,)) as pool:
+        pending = deque()
+        for batch in batch_iter:
+            pending.append(pool.submit(classify_batch, batch))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+class Report:
+    def __init__(self, show: int):
+        self.show = show
+        self.total = 0
+        self.spam = 0
+        self.rules = Counter()
+        self.scores = Counter()
+        self.confusion = Counter()
+        self.errors = {"fp": [], "fn": []}
+        self.baseline_rules = Counter()
+        self.flips = {"new_spam": [], "no_longer_spam": []}
+        self.flip_counts = Counter()
+
+    def _sample(self, bucket, key, text):
+        if len(bucket) < self.show:
+            bucket.append((key, text[:120].replace("\n", " ")))
+
+    def add(self, key, text, label, verdicts):
+        verdict = verdicts[0]
+        self.total += 1
+        self.spam += verdict.is_spam
+        self.rules.update(verdict.rules)
+        self.scores[verdict.score] += 1
+        if label is not None:
+            label = bool(label)
+            self.confusion[(label, verdict.is_spam)] += 1
+            if verdict.is_spam and not label:
+                self._sample(self.errors["fp"], key, text)
+            elif label and not verdict.is_spam:
+                self._sample(self.errors["fn"], key, text)
+        if len(verdicts) > 1:
+            previous = verdicts[1]
+            self.baseline_rules.update(previous.rules)
+            if verdict.is_spam != previous.is_spam:
+                flip = "new_spam" if verdict.is_spam else "no_longer_spam"
+                self.flip_counts[flip] += 1
+                self._sample(self.flips[flip], key, text)
+
+    def print(self, elapsed: float, baseline: bool):
+        print(f"Сообщений: {self.total}, спам: {self.spam} ({self.spam / max(self.total, 1):.1%}), "
+              f"{self.total / elapsed:,.0f} msg/s за {elapsed:.1f} с")
+        print("\nСрабатывания правил:")
+        for name in [name for name, _, _ in bot.SPAM_RULES] + [bot.FLOOD_RULE]:
+            line = f"  {name:<12} {self.rules[name]:>8}"
+            if baseline:
+                line += f"  (было {self.baseline_rules[name]}, {self.rules[name] - self.baseline_rules[name]:+d})"
+            print(line)
+        print("\nРаспределение баллов:")
+        peak = max(self.scores.values(), default=1)
+        for score in sorted(self.scores):
+            print(f"  {score:>2} {self.scores[score]:>8} {'#' * max(1, 40 * self.scores[score] // peak)}")
+        if self.confusion:
+            tp, fp = self.confusion[(True, True)], self.confusion[(False, True)]
+            fn, tn = self.confusion[(True, False)], self.confusion[(False, False)]
+            print(f"\nРазметка: TP {tp}, FP {fp}, FN {fn}, TN {tn}, "
+                  f"точность {tp / max(tp + fp, 1):.1%}, полнота {tp / max(tp + fn, 1):.1%}")
+            for name, title in (("fp", "Ложные срабатывания"), ("fn", "Пропущенный спам")):
+                for key, text in self.errors[name]:
+                    print(f"  {title}: {key}: {text}")
+        if baseline:
+            print(f"\nПротив прежних правил: стало спамом {self.flip_counts['new_spam']}, "
+                  f"перестало быть спамом {self.flip_counts['no_longer_spam']}")
+            for name, title in (("new_spam", "+ спам"), ("no_longer_spam", "- спам")):
+                for key, text in self.flips[name]:
+                    print(f"  {title}: {key}: {text}")
+
+def load_labels(path: str):
+    return {record["id"]: bool(record["spam"]) for record in iter_jsonl(path)}
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-прогон классификатора спама по выгрузке чата")
+    parser.add_argument("path", help="result.json из Telegram Desktop или JSONL (сообщения/апдейты)")
+    parser.add_argument("--workers", type=int, default=None, help="процессов (по умолчанию — число ядер)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--labels", help='JSONL с разметкой: {"id": ..., "spam": true}')
+    parser.add_argument("--rules", help="JSON с прежней версией правил для сравнения")
+    parser.add_argument("--dump-rules", help="сохранить текущие правила в JSON и выйти")
+    parser.add_argument("--show", type=int, default=5, help="примеров на каждый вид расхождений")
+    parser.add_argument("--out", help="записать вердикты в JSONL")
+    args = parser.parse_args()
+    if args.dump_rules:
+        dump_rules(args.dump_rules)
+        return
+    baseline = load_rules(args.rules) if args.rules else None
+    labels = load_labels(args.labels) if args.labels else {}
+    records = iter_jsonl(args.path) if args.path.endswith(".jsonl") else iter_export_messages(args.path)
+    report = Report(args.show)
+    out = open(args.out, "w", encoding="utf-8") if args.out else None
+    started = time.perf_counter()
+    try:
+        workers = args.workers or os.cpu_count()
+        for key, text, label, verdicts in run_pool(batches(records, args.batch_size), workers, baseline):
+            report.add(key, text, labels.get(key, label), verdicts)
+            if out:
+                verdict = verdicts[0]
+                out.write(json.dumps({"id": key, "spam": verdict.is_spam, "score": verdict.score,
+                                      "rules": verdict.rules}, ensure_ascii=False) + "\n")
+    finally:
+        if out:
+            out.close()
+    report.print(time.perf_counter() - started, baseline is not None)
+
+if __name__ == '__main__':
+    main()